@@ -0,0 +1,58 @@
+"""
+Сравнение двух прогонов bench/run.py. Падает (exit 1), если p95 или пропускная способность
+какого-то сценария ухудшились больше чем на BENCH_REGRESSION_PCT процентов.
+
+    python -m bench.compare                          # два последних результата
+    python -m bench.compare base.json new.json
+"""
+import glob
+import json
+import os
+import sys
+
+# Тот же каталог, что и в bench/run.py (не импортируем его, чтобы не тянуть БД и бота)
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+BENCH_REGRESSION_PCT = float(os.getenv("BENCH_REGRESSION_PCT", 10))
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+def change(old, new):
+    if old in (None, 0) or new is None:
+        return None
+    return (new - old) / old * 100
+
+def compare(base, new):
+    """Печатает таблицу и возвращает список регрессий."""
+    regressions = []
+    print(f"{'flow':<22}{'metric':<14}{base['commit']:>14}{new['commit']:>14}{'change':>10}")
+    for flow, result in new["flows"].items():
+        old = base["flows"].get(flow)
+        if old is None:
+            continue
+        for metric, higher_is_worse in (("p50_ms", True), ("p95_ms", True), ("p99_ms", True), ("per_second", False)):
+            pct = change(old.get(metric), result.get(metric))
+            shown = "" if pct is None else f"{pct:+.1f}%"
+            print(f"{flow:<22}{metric:<14}{old.get(metric)!s:>14}{result.get(metric)!s:>14}{shown:>10}")
+            worse = pct is not None and (pct if higher_is_worse else -pct) > BENCH_REGRESSION_PCT
+            if worse and metric in ("p95_ms", "per_second"):
+                regressions.append(f"{flow} {metric} {shown}")
+    if base.get("params") != new.get("params"):
+        print("Warning: runs used different parameters, numbers are not directly comparable")
+    return regressions
+
+def main(argv):
+    if len(argv) == 2:
+        paths = argv
+    else:
+        paths = sorted(glob.glob(os.path.join(RESULTS_DIR, "*.json")), key=os.path.getmtime)[-2:]
+        if len(paths) < 2:
+            sys.exit("Need two result files in bench/results")
+    regressions = compare(load(paths[0]), load(paths[1]))
+    for line in regressions:
+        print("REGRESSION:", line)
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,61 @@
+"""
+Заглушка Bot API для нагрузочных тестов: принимает любые методы и сразу отвечает успехом.
+
+    python -m bench.fake_bot_api            # отдельным процессом, порт FAKE_API_PORT
+    BOT_API_URL=http://127.0.0.1:8081 ...   # куда направить бота
+"""
+import asyncio
+import os
+import time
+from collections import Counter
+from aiohttp import web
+
+FAKE_API_HOST = os.getenv("FAKE_API_HOST", "127.0.0.1")
+FAKE_API_PORT = int(os.getenv("FAKE_API_PORT", 8081))
+# Искусственная задержка ответа, чтобы приблизиться к настоящему Telegram
+FAKE_API_LATENCY_MS = float(os.getenv("FAKE_API_LATENCY_MS", 0))
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+
+# Число вызовов по методам - для отчёта
+calls = Counter()
+
+def _message(chat_id, message_id=1, text=None):
+    return {
+        "message_id": message_id,
+        "date": int(time.time()),
+        "chat": {"id": int(chat_id or 0), "type": "private"},
+        "from": BOT_USER,
+        "text": text,
+    }
+
+def _result(method: str, params):
+    method = method.lower()
+    if method == "getme":
+        return BOT_USER
+    if method.startswith(("send", "edit", "copy", "forward")):
+        return _message(params.get("chat_id"), params.get("message_id") or 1, params.get("text"))
+    return True
+
+async def handle_method(request):
+    method = request.match_info["method"]
+    calls[method] += 1
+    params = await request.post()
+    if FAKE_API_LATENCY_MS:
+        await asyncio.sleep(FAKE_API_LATENCY_MS / 1000)
+    return web.json_response({"ok": True, "result": _result(method, params)})
+
+def make_app():
+    app = web.Application(client_max_size=50 * 1024 * 1024)
+    app.router.add_post("/bot{token}/{method}", handle_method)
+    return app
+
+async def start(host=FAKE_API_HOST, port=FAKE_API_PORT):
+    """Запустить заглушку в текущем цикле событий. Возвращает runner (для cleanup)."""
+    runner = web.AppRunner(make_app())
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+if __name__ == "__main__":
+    web.run_app(make_app(), host=FAKE_API_HOST, port=FAKE_API_PORT)
@@ -0,0 +1,264 @@
+"""
+Нагрузочный прогон основных сценариев через main.handle_webhook (синхронный режим вебхука),
+исходящие запросы бота уходят в заглушку Bot API (bench/fake_bot_api.py).
+Результат сохраняется в bench/results/<commit>.json, сравнение - bench/compare.py.
+
+    DATABASE_URL=... python -m bench.seed
+    DATABASE_URL=... python -m bench.run [flow ...]
+"""
+import os
+import sys
+
+from bench.fake_bot_api import FAKE_API_HOST, FAKE_API_PORT
+# bench.seed не импортирует бота, поэтому его можно загрузить до настройки окружения
+from bench.seed import BENCH_USER_BASE, BENCH_USERS, BENCH_DEPARTMENTS, BENCH_TASKS
+
+# Окружение бота задаём до импорта main: заглушка вместо Telegram и обработка до ответа
+os.environ.setdefault("BOT_API_URL", f"http://{FAKE_API_HOST}:{FAKE_API_PORT}")
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+os.environ.setdefault("ADMIN_ID", str(BENCH_USER_BASE))
+os.environ["WEBHOOK_MODE"] = "sync"
+# Сценарии шлют одно и то же нажатие от одного пользователя десятки раз в секунду:
+# с ограничением частоты измерялись бы ответы "слишком часто", а не хендлеры
+os.environ["THROTTLE_ENABLED"] = "0"
+
+import asyncio
+import json
+import logging
+import platform
+import random
+import subprocess
+import time
+from datetime import datetime
+from sqlalchemy import select, update, func
+from bench import fake_bot_api
+import logconfig
+import metrics
+
+BENCH_REQUESTS = int(os.getenv("BENCH_REQUESTS", 500))
+BENCH_EXPORT_REQUESTS = int(os.getenv("BENCH_EXPORT_REQUESTS", 5))
+BENCH_CONCURRENCY = int(os.getenv("BENCH_CONCURRENCY", 20))
+BENCH_ESCALATION_RUNS = int(os.getenv("BENCH_ESCALATION_RUNS", 20))
+BENCH_ESCALATION_BATCH = int(os.getenv("BENCH_ESCALATION_BATCH", 200))
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+class BenchRequest:
+    """Минимальный aiohttp-запрос для handle_webhook: заголовки, match_info и тело."""
+    method = "POST"
+
+    def __init__(self, body: bytes, token: str, secret: str = None):
+        self.body = body
+        self.match_info = {"token": token}
+        self.headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+
+    async def read(self):
+        return self.body
+
+def _user(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": "bench", "username": f"bench_{user_id}"}
+
+def _chat(user_id):
+    return {"id": user_id, "type": "private"}
+
+def message_update(update_id, user_id, text):
+    message = {
+        "message_id": update_id, "date": int(time.time()),
+        "chat": _chat(user_id), "from": _user(user_id), "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+def callback_update(update_id, user_id, data):
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id), "from": _user(user_id), "chat_instance": "bench", "data": data,
+            "message": {
+                "message_id": 1, "date": int(time.time()), "chat": _chat(user_id),
+                "from": fake_bot_api.BOT_USER, "text": "menu",
+            },
+        },
+    }
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+def summarize(latencies, errors, wall, queries=None):
+    return {
+        "count": len(latencies),
+        "errors": errors,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2) if latencies else None,
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2) if latencies else None,
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+        "per_second": round(len(latencies) / wall, 2) if wall else None,
+        "db_queries_per_update": queries,
+    }
+
+class LogContextCheck(logging.Handler):
+    """Проверка: у каждой записи aiogram.event ("Update id=... is handled") есть контекст апдейта."""
+
+    def __init__(self):
+        super().__init__()
+        self.records = 0
+        self.without_update_id = 0
+
+    def emit(self, record):
+        if record.name == "aiogram.event":
+            self.records += 1
+            if logconfig.update_id_var.get() is None:
+                self.without_update_id += 1
+
+def _query_totals():
+    # (сумма, число апдейтов) из гистограммы запросов на апдейт
+    row = metrics.db_queries.values.get(())
+    return (row[-1], sum(row[:-1])) if row else (0, 0)
+
+async def run_updates(main, make_update, count, concurrency):
+    """Прогнать count апдейтов через handle_webhook, не больше concurrency одновременно."""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], 0
+    token, secret = main.bot.token, main.WEBHOOK_SECRET
+    queries_before = _query_totals()
+
+    async def one(n):
+        nonlocal errors
+        body = json.dumps(make_update(n)).encode()
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                response = await main.handle_webhook(BenchRequest(body, token, secret))
+                ok = response.status == 200
+            except Exception:
+                ok = False
+            latencies.append(time.perf_counter() - start)
+        if not ok:
+            errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(n) for n in range(count)))
+    wall = time.perf_counter() - start
+    total, updates = (a - b for a, b in zip(_query_totals(), queries_before))
+    return summarize(latencies, errors, wall, round(total / updates, 2) if updates else None)
+
+async def run_escalation(runs, batch):
+    """Время escalate_due: перед каждым прогоном batch случайных задач получают истёкший срок."""
+    from db import AsyncSessionLocal
+    from models import Task, TaskStatusEnum
+    from scheduler import escalate_due
+
+    latencies, errors = [], 0
+    start = time.perf_counter()
+    for _ in range(runs):
+        async with AsyncSessionLocal() as session:
+            ids = (await session.execute(
+                select(Task.id).where(Task.issued_by >= BENCH_USER_BASE).order_by(func.random()).limit(batch)
+            )).scalars().all()
+            await session.execute(
+                update(Task).where(Task.id.in_(ids))
+                .values(status=TaskStatusEnum.new, due_at=datetime.utcnow())
+                .execution_options(synchronize_session=False)
+            )
+            await session.commit()
+        run_start = time.perf_counter()
+        try:
+            await escalate_due()
+        except Exception:
+            errors += 1
+        latencies.append(time.perf_counter() - run_start)
+    return summarize(latencies, errors, time.perf_counter() - start)
+
+async def bench_users():
+    from db import AsyncSessionLocal
+    from models import User, RoleEnum
+    async with AsyncSessionLocal() as session:
+        rows = (await session.execute(
+            select(User.id, User.role).where(User.id.between(BENCH_USER_BASE, BENCH_USER_BASE + BENCH_USERS - 1))
+        )).all()
+    employees = [row.id for row in rows if row.role == RoleEnum.employee]
+    if not employees:
+        sys.exit("No benchmark users found, run `python -m bench.seed` first")
+    return [row.id for row in rows], employees
+
+def commit_id():
+    try:
+        sha = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+        dirty = subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return sha + ("-dirty" if dirty else "")
+
+async def run(flows):
+    runner = await fake_bot_api.start()
+    import main
+    from events import task_events
+    from notifications import outbox
+
+    log_check = LogContextCheck()
+    logging.getLogger().addHandler(log_check)
+    await outbox.start()
+    task_events.start()
+    all_users, employees = await bench_users()
+    admin = BENCH_USER_BASE
+    rnd = random.Random(0)
+    # Уникальные между запусками update_id, чтобы повторный прогон не отсеивался как дубликаты
+    update_ids = iter(range(int(time.time()) * 1000, 2**52))
+
+    scenarios = {
+        "start": lambda: run_updates(
+            main, lambda n: message_update(next(update_ids), rnd.choice(all_users), "/start"),
+            BENCH_REQUESTS, BENCH_CONCURRENCY),
+        "tasks:my": lambda: run_updates(
+            main, lambda n: callback_update(next(update_ids), rnd.choice(employees), "tasks:my"),
+            BENCH_REQUESTS, BENCH_CONCURRENCY),
+        "stats:admin:users": lambda: run_updates(
+            main, lambda n: callback_update(next(update_ids), admin, "stats:admin:users"),
+            BENCH_REQUESTS, BENCH_CONCURRENCY),
+        "stats:admin:export": lambda: run_updates(
+            main, lambda n: callback_update(next(update_ids), admin, "stats:admin:export"),
+            BENCH_EXPORT_REQUESTS, 1),
+        "escalation": lambda: run_escalation(BENCH_ESCALATION_RUNS, BENCH_ESCALATION_BATCH),
+    }
+    results = {}
+    try:
+        for name in flows or scenarios:
+            print(f"{name}...", flush=True)
+            results[name] = await scenarios[name]()
+            print(f"  {results[name]}", flush=True)
+    finally:
+        await task_events.stop()
+        await outbox.stop()
+        await main.bot.session.close()
+        await runner.cleanup()
+        logging.getLogger().removeHandler(log_check)
+
+    return {
+        "commit": commit_id(),
+        "date": datetime.utcnow().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "params": {
+            "users": BENCH_USERS, "departments": BENCH_DEPARTMENTS, "tasks": BENCH_TASKS,
+            "requests": BENCH_REQUESTS, "export_requests": BENCH_EXPORT_REQUESTS,
+            "concurrency": BENCH_CONCURRENCY, "escalation_runs": BENCH_ESCALATION_RUNS,
+            "escalation_batch": BENCH_ESCALATION_BATCH, "fake_api_latency_ms": fake_bot_api.FAKE_API_LATENCY_MS,
+        },
+        "bot_api_calls": dict(fake_bot_api.calls),
+        "flows": results,
+        "log_context": {"aiogram_event_records": log_check.records, "without_update_id": log_check.without_update_id},
+    }
+
+def save(result) -> str:
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, f"{result['commit']}.json")
+    with open(path, "w") as f:
+        json.dump(result, f, indent=2, ensure_ascii=False)
+    return path
+
+if __name__ == "__main__":
+    result = asyncio.run(run(sys.argv[1:]))
+    print("Saved", save(result))
+    if result["log_context"]["without_update_id"]:
+        sys.exit(f"{result['log_context']['without_update_id']} aiogram.event records without update_id")
@@ -0,0 +1,107 @@
+"""
+Наполнение БД синтетическими данными для нагрузочных тестов.
+Данные бенчмарка занимают отдельный диапазон id и пересоздаются при каждом запуске.
+
+    DATABASE_URL=... BENCH_USERS=1000 BENCH_DEPARTMENTS=20 BENCH_TASKS=20000 python -m bench.seed
+"""
+import asyncio
+import os
+import random
+from datetime import datetime, timedelta
+from sqlalchemy import insert, delete, or_
+from db import engine, AsyncSessionLocal
+from migrations import migrate
+from models import User, Department, Task, RoleEnum, TaskStatusEnum
+from deadlines import NEW_TASK_DEADLINE, REVIEW_DEADLINE
+import stats
+
+BENCH_USERS = int(os.getenv("BENCH_USERS", 1000))
+BENCH_DEPARTMENTS = int(os.getenv("BENCH_DEPARTMENTS", 20))
+BENCH_TASKS = int(os.getenv("BENCH_TASKS", 20000))
+BENCH_SEED = int(os.getenv("BENCH_SEED", 42))
+# Пользователи бенчмарка: BENCH_USER_BASE - администратор, дальше руководители и сотрудники
+BENCH_USER_BASE = int(os.getenv("BENCH_USER_BASE", 1_000_000_000))
+BENCH_DEPARTMENT_PREFIX = "bench-"
+CHUNK = 5000
+
+STATUS_WEIGHTS = {
+    TaskStatusEnum.new: 2,
+    TaskStatusEnum.in_progress: 2,
+    TaskStatusEnum.submitted: 2,
+    TaskStatusEnum.done: 6,
+    TaskStatusEnum.escalated: 1,
+    TaskStatusEnum.overdue: 1,
+}
+
+def user_ids():
+    return range(BENCH_USER_BASE, BENCH_USER_BASE + BENCH_USERS)
+
+async def clear(session):
+    ids = user_ids()
+    in_range = lambda column: column.between(ids.start, ids.stop - 1)
+    await session.execute(delete(Task).where(or_(in_range(Task.issued_by), in_range(Task.assigned_to))))
+    await session.execute(delete(User).where(in_range(User.id)))
+    await session.execute(delete(Department).where(Department.name.startswith(BENCH_DEPARTMENT_PREFIX)))
+
+def _due_at(status, created_at, updated_at):
+    if status in (TaskStatusEnum.new, TaskStatusEnum.in_progress):
+        return created_at + NEW_TASK_DEADLINE
+    if status == TaskStatusEnum.submitted:
+        return updated_at + REVIEW_DEADLINE
+    return None
+
+async def seed():
+    rnd = random.Random(BENCH_SEED)
+    now = datetime.utcnow()
+    await migrate(engine)
+    async with AsyncSessionLocal() as session:
+        await clear(session)
+        departments = (await session.execute(
+            insert(Department)
+            .values([{"name": f"{BENCH_DEPARTMENT_PREFIX}{i}"} for i in range(BENCH_DEPARTMENTS)])
+            .returning(Department.id)
+        )).scalars().all()
+
+        users, employees = [], []
+        for n, user_id in enumerate(user_ids()):
+            if n == 0:
+                role, department_id = RoleEnum.admin, None
+            elif n <= len(departments):
+                role, department_id = RoleEnum.manager, departments[n - 1]
+            else:
+                role, department_id = RoleEnum.employee, rnd.choice(departments)
+                employees.append((user_id, department_id))
+            users.append({
+                "id": user_id, "username": f"bench_user_{n}", "is_active": True,
+                "role": role, "department_id": department_id, "points": rnd.randint(0, 500),
+            })
+        await session.execute(insert(User), users)
+
+        statuses, weights = list(STATUS_WEIGHTS), list(STATUS_WEIGHTS.values())
+        for start in range(0, BENCH_TASKS, CHUNK):
+            rows = []
+            for _ in range(start, min(start + CHUNK, BENCH_TASKS)):
+                assignee, department_id = rnd.choice(employees)
+                status = rnd.choices(statuses, weights)[0]
+                created_at = now - timedelta(seconds=rnd.randint(60, 14 * 24 * 3600))
+                updated_at = min(created_at + timedelta(seconds=rnd.randint(60, 48 * 3600)), now)
+                rows.append({
+                    "title": f"bench task {rnd.randint(1, 10**6)}",
+                    "description": "synthetic",
+                    "status": status,
+                    "created_at": created_at,
+                    "updated_at": updated_at,
+                    "due_at": _due_at(status, created_at, updated_at),
+                    "assigned_to": None if status == TaskStatusEnum.new else assignee,
+                    "issued_by": rnd.choice(employees)[0],
+                    "department_id": department_id,
+                })
+            await session.execute(insert(Task), rows)
+
+        await stats.reconcile(session)
+        await session.commit()
+    await engine.dispose()
+    print(f"Seeded {BENCH_USERS} users, {BENCH_DEPARTMENTS} departments, {BENCH_TASKS} tasks")
+
+if __name__ == "__main__":
+    asyncio.run(seed())
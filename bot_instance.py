@@ -1,6 +1,13 @@
 from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 import os
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+# Другой адрес Bot API: локальный telegram-bot-api или заглушка для нагрузочных тестов (bench/)
+BOT_API_URL = os.getenv("BOT_API_URL")
 
-bot = Bot(token=BOT_TOKEN)
+if BOT_API_URL:
+    bot = Bot(token=BOT_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(BOT_API_URL)))
+else:
+    bot = Bot(token=BOT_TOKEN)
@@ -0,0 +1,59 @@
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from models import RoleEnum
+
+class TTLCache:
+    """Ограниченный по размеру LRU-кэш с временем жизни записей."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self.data.get(key)
+        if item is None:
+            return default
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self.data[key]
+            return default
+        self.data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self.data[key] = (time.monotonic() + self.ttl, value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def invalidate(self, key):
+        self.data.pop(key, None)
+
+    def clear(self):
+        self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+@dataclass(frozen=True)
+class CachedUser:
+    """Снимок пользователя для проверки доступа (без баллов - они меняются слишком часто)."""
+    id: int
+    username: str
+    is_active: bool
+    role: RoleEnum
+    department_id: int
+
+    @classmethod
+    def from_model(cls, user):
+        return cls(user.id, user.username, user.is_active, user.role, user.department_id)
+
+# Текущие пользователи бота (id -> CachedUser); при изменении пользователя в админке
+# запись сбрасывается во всех процессах через refdata.user_changed
+user_cache = TTLCache(
+    maxsize=int(os.getenv("USER_CACHE_SIZE", 10000)),
+    ttl=float(os.getenv("USER_CACHE_TTL", 60)),
+)
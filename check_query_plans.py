@@ -0,0 +1,68 @@
+"""
+Проверка планов горячих запросов: падает (exit 1), если какой-то из них
+читает таблицу последовательным сканированием вместо индекса.
+
+    DATABASE_URL=... python check_query_plans.py
+"""
+import asyncio
+import json
+import sys
+from datetime import datetime
+from sqlalchemy import select, func, text
+from sqlalchemy.dialects import postgresql
+from db import engine
+from migrations import migrate
+from models import Task, TaskStatusEnum, User, RoleEnum
+
+def hot_queries():
+    now = datetime.utcnow()
+    return {
+        "my_tasks_menu": select(Task.id).where(
+            Task.assigned_to == 1,
+            Task.status.in_([TaskStatusEnum.in_progress, TaskStatusEnum.submitted])
+        ),
+        "escalation: overdue": select(Task.id).where(
+            Task.status.in_([TaskStatusEnum.new, TaskStatusEnum.in_progress]),
+            Task.due_at <= now
+        ),
+        "escalation: submitted": select(Task.id).where(
+            Task.status == TaskStatusEnum.submitted,
+            Task.due_at <= now
+        ),
+        "deadlines: load": select(Task.id, Task.due_at).where(Task.due_at.isnot(None)),
+        "department manager": select(User.id).where(
+            User.department_id == 1,
+            User.role == RoleEnum.manager,
+            User.is_active == True
+        ),
+        "department tasks": select(func.count(Task.id)).where(Task.department_id == 1),
+    }
+
+def seq_scans(plan):
+    if plan.get("Node Type") == "Seq Scan":
+        yield plan.get("Relation Name")
+    for child in plan.get("Plans", []):
+        yield from seq_scans(child)
+
+async def main():
+    await migrate(engine)
+    failed = []
+    async with engine.connect() as conn:
+        # На маленьких тестовых таблицах планировщик и так выберет seq scan,
+        # поэтому запрещаем его: если индекса нет - seq scan всё равно останется
+        await conn.execute(text("SET enable_seqscan = off"))
+        for name, query in hot_queries().items():
+            sql = str(query.compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}))
+            plan = (await conn.execute(text("EXPLAIN (FORMAT JSON) " + sql))).scalar()
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            tables = list(seq_scans(plan[0]["Plan"]))
+            status = "SEQ SCAN on " + ", ".join(tables) if tables else "ok"
+            print(f"{name}: {status}")
+            if tables:
+                failed.append(name)
+    await engine.dispose()
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,104 @@
+import asyncio
+import heapq
+import logging
+import os
+from datetime import datetime, timedelta
+from sqlalchemy import select
+from db import AsyncSessionLocal
+from models import Task
+
+logger = logging.getLogger(__name__)
+
+# Сроки эскалации: новая задача - 24ч с создания, задача на проверке - 12ч с отправки
+NEW_TASK_DEADLINE = timedelta(hours=int(os.getenv("NEW_TASK_DEADLINE_HOURS", 24)))
+REVIEW_DEADLINE = timedelta(hours=int(os.getenv("REVIEW_DEADLINE_HOURS", 12)))
+# Небольшая задержка, чтобы близкие по времени сроки обработать одним запросом
+DEADLINE_GRACE = float(os.getenv("DEADLINE_GRACE", 1))
+
+class DeadlineScheduler:
+    """
+    Сроки задач в памяти (куча по due_at). Когда подходит ближайший срок, вызывается
+    callback - он сам выбирает из БД все задачи с due_at <= now (по индексу ix_tasks_due_at).
+    Отменённые и перенесённые сроки остаются в куче и пропускаются при извлечении.
+    """
+
+    def __init__(self, grace=DEADLINE_GRACE):
+        self.grace = grace
+        self.heap = []  # [(due_at, task_id)]
+        self.due = {}   # task_id -> актуальный due_at
+        self.callback = None
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def schedule(self, task_id: int, due_at: datetime = None):
+        if due_at is None:
+            self.cancel(task_id)
+            return
+        self.due[task_id] = due_at
+        if not self.heap or due_at < self.heap[0][0]:
+            self.wakeup.set()
+        heapq.heappush(self.heap, (due_at, task_id))
+        if len(self.heap) > 2 * len(self.due) + 1000:
+            self._compact()
+
+    def cancel(self, task_id: int):
+        self.due.pop(task_id, None)
+
+    def _compact(self):
+        self.heap = [(due_at, task_id) for task_id, due_at in self.due.items()]
+        heapq.heapify(self.heap)
+
+    def _pop_due(self, now) -> int:
+        fired = 0
+        while self.heap and self.heap[0][0] <= now:
+            due_at, task_id = heapq.heappop(self.heap)
+            if self.due.get(task_id) == due_at:
+                del self.due[task_id]
+                fired += 1
+        return fired
+
+    def _next_delay(self):
+        # Сначала выбрасываем отменённые записи с вершины кучи
+        while self.heap and self.due.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        if not self.heap:
+            return None
+        return max((self.heap[0][0] - datetime.utcnow()).total_seconds(), 0) + self.grace
+
+    async def load(self):
+        """Восстановить сроки из БД одним запросом по частичному индексу."""
+        async with AsyncSessionLocal() as session:
+            rows = (await session.execute(
+                select(Task.id, Task.due_at).where(Task.due_at.isnot(None))
+            )).all()
+        self.due = {row.id: row.due_at for row in rows}
+        self._compact()
+        self.wakeup.set()
+        logger.info("Deadlines: loaded %d pending task deadlines", len(self.due))
+
+    async def _run(self):
+        while True:
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self._next_delay())
+            except asyncio.TimeoutError:
+                pass
+            if not self._pop_due(datetime.utcnow()):
+                continue
+            try:
+                await self.callback()
+            except Exception:
+                logger.exception("Deadlines: escalation failed")
+
+    async def start(self, callback):
+        self.callback = callback
+        await self.load()
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+deadlines = DeadlineScheduler()
@@ -0,0 +1,83 @@
+import logging
+import os
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from sqlalchemy import delete
+from sqlalchemy.dialects.postgresql import insert
+from db import AsyncSessionLocal
+from models import ProcessedUpdate
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Сколько последних update_id помнит процесс
+DEDUP_SIZE = int(os.getenv("DEDUP_SIZE", 10000))
+# Общее для всех реплик окно в БД (одна вставка на апдейт)
+DEDUP_DB = os.getenv("DEDUP_DB", "0") == "1"
+# Telegram повторяет доставку не дольше суток
+DEDUP_WINDOW = timedelta(hours=float(os.getenv("DEDUP_WINDOW_HOURS", 24)))
+
+class UpdateDeduplicator:
+    """
+    Отсеивает повторные доставки одного апдейта (Telegram повторяет их при медленном ответе или 5xx).
+    Апдейт помечается принятым до обработки; если обработать его не удалось и Telegram
+    должен прислать его снова - вызывается forget().
+    """
+
+    def __init__(self, maxsize=DEDUP_SIZE, use_db=DEDUP_DB):
+        self.maxsize = maxsize
+        self.use_db = use_db
+        self.recent = OrderedDict()
+
+    def _remember(self, update_id):
+        self.recent[update_id] = None
+        if len(self.recent) > self.maxsize:
+            self.recent.popitem(last=False)
+
+    async def seen(self, update_id: int) -> bool:
+        """True - апдейт уже принимали, повторно обрабатывать не нужно."""
+        metrics.updates_received.inc()
+        if update_id in self.recent:
+            metrics.updates_duplicate.inc("memory")
+            return True
+        self._remember(update_id)
+        if not self.use_db:
+            return False
+        try:
+            async with AsyncSessionLocal() as session:
+                inserted = (await session.execute(
+                    insert(ProcessedUpdate)
+                    .values(update_id=update_id, received_at=datetime.utcnow())
+                    .on_conflict_do_nothing(index_elements=[ProcessedUpdate.update_id])
+                    .returning(ProcessedUpdate.update_id)
+                )).first()
+                await session.commit()
+        except Exception:
+            # Лучше обработать возможный дубликат, чем потерять апдейт
+            logger.exception("Dedup: failed to record update %s", update_id)
+            return False
+        if inserted is None:
+            metrics.updates_duplicate.inc("db")
+            return True
+        return False
+
+    async def forget(self, update_id: int):
+        self.recent.pop(update_id, None)
+        if not self.use_db:
+            return
+        try:
+            async with AsyncSessionLocal() as session:
+                await session.execute(delete(ProcessedUpdate).where(ProcessedUpdate.update_id == update_id))
+                await session.commit()
+        except Exception:
+            logger.exception("Dedup: failed to forget update %s", update_id)
+
+async def delete_old_updates() -> int:
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            delete(ProcessedUpdate).where(ProcessedUpdate.received_at < datetime.utcnow() - DEDUP_WINDOW)
+        )
+        await session.commit()
+    return result.rowcount
+
+dedup = UpdateDeduplicator()
@@ -0,0 +1,85 @@
+import asyncio
+import logging
+import os
+from datetime import datetime
+from sqlalchemy import insert
+from db import AsyncSessionLocal
+from models import TaskEvent
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Сбрасываем журнал каждые N событий или каждые T миллисекунд - что наступит раньше
+EVENTS_BATCH_SIZE = int(os.getenv("TASK_EVENTS_BATCH_SIZE", 500))
+EVENTS_FLUSH_MS = int(os.getenv("TASK_EVENTS_FLUSH_MS", 500))
+# Потолок буфера, пока БД недоступна: сверх него новые события отбрасываются (bot_task_events_dropped_total).
+# Журнал - вспомогательный: без событий статистика берёт время из created_at/updated_at задачи.
+EVENTS_MAX_BUFFER = int(os.getenv("TASK_EVENTS_MAX_BUFFER", 50000))
+
+class TaskEventWriter:
+    """Буферизованная запись в task_events: одно INSERT на пачку событий."""
+
+    def __init__(self, batch_size=EVENTS_BATCH_SIZE, flush_ms=EVENTS_FLUSH_MS, max_buffer=EVENTS_MAX_BUFFER):
+        self.batch_size = batch_size
+        self.max_buffer = max_buffer
+        self.flush_interval = flush_ms / 1000
+        self.buffer = []
+        self.lock = asyncio.Lock()
+        self.task = None
+        self.full = asyncio.Event()
+
+    def record(self, task_id: int, to_status, from_status=None, user_id: int = None, at: datetime = None):
+        if len(self.buffer) >= self.max_buffer:
+            metrics.task_events_dropped.inc()
+            return
+        self.buffer.append({
+            "task_id": task_id,
+            "from_status": from_status,
+            "to_status": to_status,
+            "user_id": user_id,
+            "at": at or datetime.utcnow(),
+        })
+        if len(self.buffer) >= self.batch_size:
+            self.full.set()
+
+    async def flush(self):
+        async with self.lock:
+            if not self.buffer:
+                return
+            batch, self.buffer = self.buffer, []
+            try:
+                async with AsyncSessionLocal() as session:
+                    await session.execute(insert(TaskEvent), batch)
+                    await session.commit()
+            except Exception:
+                # Вернём события в начало буфера - запишем со следующей пачкой
+                self.buffer[:0] = batch
+                overflow = len(self.buffer) - self.max_buffer
+                if overflow > 0:
+                    del self.buffer[self.max_buffer:]
+                    metrics.task_events_dropped.inc(value=overflow)
+                raise
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.full.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.full.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Failed to write %d task events", len(self.buffer))
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        await self.flush()
+
+task_events = TaskEventWriter()
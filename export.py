@@ -0,0 +1,195 @@
+import asyncio
+import csv
+import io
+import os
+import queue
+import tempfile
+import zipfile
+import openpyxl
+from sqlalchemy import select
+from sqlalchemy.orm import aliased
+from models import User, Department, Task
+import stats
+
+# Сколько строк за раз забираем из курсора и передаем в поток записи
+CHUNK_SIZE = 1000
+# Ограничение листа Excel (вместе со строкой заголовка)
+XLSX_MAX_ROWS = 1_048_576
+XLSX_MAX_TITLE = 31
+
+USERS_HEADER = ["ID", "Username", "Роль", "Отдел", "Баллы", "Штрафы", "Всего задач", "Среднее время (ч)"]
+DEPTS_HEADER = ["ID", "Название", "Баллы", "Всего задач", "Среднее время (ч)"]
+TASKS_HEADER = ["ID", "Заголовок", "Статус", "Отдел", "Исполнитель", "Создана", "Обновлена"]
+
+_END = object()
+
+class _XlsxSink:
+    """Потоковая (write-only) книга: строки сразу уходят на диск, память не растёт."""
+
+    extension = "xlsx"
+
+    def __init__(self, path):
+        self.path = path
+        self.wb = openpyxl.Workbook(write_only=True)
+        self.ws = None
+
+    def _new_sheet(self, title, header):
+        self.ws = self.wb.create_sheet(title[:XLSX_MAX_TITLE])
+        self.ws.append(header)
+        self.rows_left = XLSX_MAX_ROWS - 1
+
+    def start_sheet(self, title, header):
+        self.title, self.header, self.part = title, header, 1
+        self._new_sheet(title, header)
+
+    def write_rows(self, rows):
+        for row in rows:
+            # Лист переполнен - продолжаем на следующем
+            if self.rows_left == 0:
+                self.part += 1
+                self._new_sheet(f"{self.title} ({self.part})", self.header)
+            self.ws.append(row)
+            self.rows_left -= 1
+
+    def close(self):
+        self.wb.save(self.path)
+
+class _CsvSink:
+    """ZIP-архив с отдельным CSV на каждый лист - для выгрузок больше лимита Excel."""
+
+    extension = "zip"
+
+    def __init__(self, path):
+        self.zf = zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED)
+        self.stream = None
+
+    def _close_entry(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+    def start_sheet(self, title, header):
+        self._close_entry()
+        raw = self.zf.open(f"{title}.csv", "w", force_zip64=True)
+        self.stream = io.TextIOWrapper(raw, encoding="utf-8-sig", newline="")
+        self.writer = csv.writer(self.stream)
+        self.writer.writerow(header)
+
+    def write_rows(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self._close_entry()
+        self.zf.close()
+
+def _drain(sink, commands):
+    # Выполняется в отдельном потоке: вся сериализация вне event loop
+    try:
+        while True:
+            command = commands.get()
+            if command is _END:
+                break
+            kind, payload = command
+            if kind == "sheet":
+                sink.start_sheet(*payload)
+            else:
+                sink.write_rows(payload)
+    finally:
+        sink.close()
+
+async def _put(commands, writer, item):
+    # Не блокируем event loop на заполненной очереди и не виснем, если поток записи упал
+    while True:
+        if writer.done():
+            writer.result()
+            raise RuntimeError("Поток записи выгрузки остановился")
+        try:
+            commands.put_nowait(item)
+            return
+        except queue.Full:
+            await asyncio.sleep(0.05)
+
+def _abort(commands):
+    # Без await: останавливаем поток записи, даже если нас отменили. Место под _END освобождаем,
+    # выбрасывая ещё не записанные строки - файл всё равно будет удалён
+    while True:
+        try:
+            commands.put_nowait(_END)
+            return
+        except queue.Full:
+            try:
+                commands.get_nowait()
+            except queue.Empty:
+                pass
+
+async def _stream_sheet(session, commands, writer, title, header, query, convert):
+    await _put(commands, writer, ("sheet", (title, header)))
+    # session.stream использует серверный курсор (asyncpg)
+    result = await session.stream(query.execution_options(yield_per=CHUNK_SIZE))
+    async for partition in result.partitions(CHUNK_SIZE):
+        rows = [convert(row) for row in partition]
+        await _put(commands, writer, ("rows", rows))
+
+def _user_row(row):
+    s = stats.make_stats(row.points, row.total_tasks, row.avg_seconds, row.penalties)
+    return [row.id, row.username or "", row.role.value, row.department_name or "",
+            s['points'], s['penalties'], s['total_tasks'], s['avg_time_hours']]
+
+def _department_row(row):
+    s = stats.make_stats(row.points, row.total_tasks, row.avg_seconds)
+    return [row.id, row.name, s['points'], s['total_tasks'], s['avg_time_hours']]
+
+def _task_row(row):
+    return [row.id, row.title or "", row.status.value if row.status else "", row.department_name or "",
+            row.assignee or "", row.created_at, row.updated_at]
+
+def _users_query():
+    return (
+        stats.user_stats_select()
+        .add_columns(User.username, User.role, Department.name.label("department_name"))
+        .outerjoin(Department, Department.id == User.department_id)
+        .where(User.is_active == True)
+        .order_by(User.id)
+    )
+
+def _departments_query():
+    return stats.department_stats_select().add_columns(Department.name).order_by(Department.id)
+
+def _tasks_query():
+    assignee = aliased(User)
+    return (
+        select(
+            Task.id, Task.title, Task.status, Task.created_at, Task.updated_at,
+            Department.name.label("department_name"),
+            assignee.username.label("assignee"),
+        )
+        .outerjoin(Department, Department.id == Task.department_id)
+        .outerjoin(assignee, assignee.id == Task.assigned_to)
+        .order_by(Task.id)
+    )
+
+async def build_export(session, fmt="xlsx", include_tasks=False):
+    """
+    Строит выгрузку статистики во временный файл и возвращает (path, filename).
+    Файл удаляет вызывающий.
+    """
+    sink_cls = _CsvSink if fmt == "csv" else _XlsxSink
+    fd, path = tempfile.mkstemp(suffix=f".{sink_cls.extension}")
+    os.close(fd)
+    # Ограниченная очередь: курсор не убегает вперёд записи
+    commands = queue.Queue(maxsize=4)
+    writer = asyncio.create_task(asyncio.to_thread(_drain, sink_cls(path), commands))
+    try:
+        await _stream_sheet(session, commands, writer, "Пользователи", USERS_HEADER, _users_query(), _user_row)
+        await _stream_sheet(session, commands, writer, "Отделы", DEPTS_HEADER, _departments_query(), _department_row)
+        if include_tasks:
+            await _stream_sheet(session, commands, writer, "Задачи", TASKS_HEADER, _tasks_query(), _task_row)
+        await _put(commands, writer, _END)
+        await writer
+    except BaseException:
+        if not writer.done():
+            _abort(commands)
+            await asyncio.gather(writer, return_exceptions=True)
+        os.remove(path)
+        raise
+    return path, f"statistics.{sink_cls.extension}"
@@ -0,0 +1,137 @@
+import contextvars
+import os
+from datetime import datetime, timedelta
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage
+from aiogram.fsm.storage.memory import MemoryStorage
+from sqlalchemy import select, delete
+from sqlalchemy.dialects.postgresql import insert
+from db import AsyncSessionLocal
+from models import FSMState
+
+# postgres | redis | memory
+FSM_STORAGE = os.getenv("FSM_STORAGE", "postgres")
+# Через сколько секунд неактивности диалог считается брошенным
+FSM_TTL = int(os.getenv("FSM_TTL", 24 * 3600))
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+# Изменения FSM текущего апдейта: key -> _Entry. У каждого апдейта свой буфер: он создаётся
+# при первом обращении (состояние читает ещё FSM-middleware aiogram) и сбрасывается в FSMFlushMiddleware
+_pending = contextvars.ContextVar("fsm_pending", default=None)
+
+def _buffer() -> dict:
+    entries = _pending.get()
+    if entries is None:
+        entries = {}
+        _pending.set(entries)
+    return entries
+
+class _Entry:
+    __slots__ = ("state", "data", "state_loaded", "data_loaded", "state_dirty", "data_dirty")
+
+    def __init__(self):
+        self.state = None
+        self.data = {}
+        self.state_loaded = self.data_loaded = False
+        self.state_dirty = self.data_dirty = False
+
+class PostgresStorage(BaseStorage):
+    """
+    Хранилище FSM в PostgreSQL.
+    Записи буферизуются и сбрасываются одним upsert в конце апдейта (см. FSMFlushMiddleware),
+    поэтому set_state + update_data в одном шаге диалога - один запрос на запись.
+    Буфер у каждого апдейта свой, и апдейт записывает только свои ключи до выхода из middleware.
+    Апдейты одного чата в режиме очереди идут строго по порядку, поэтому следующий шаг
+    диалога всегда видит уже записанное состояние.
+    """
+
+    def __init__(self, ttl: int = FSM_TTL):
+        self.ttl = timedelta(seconds=ttl)
+
+    @staticmethod
+    def _key(key) -> str:
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{getattr(key, 'destiny', 'default')}"
+
+    async def _entry(self, key, need_state=False, need_data=False) -> _Entry:
+        k = self._key(key)
+        entries = _buffer()
+        entry = entries.get(k)
+        if entry is None:
+            entry = entries[k] = _Entry()
+        if (need_state and not entry.state_loaded) or (need_data and not entry.data_loaded):
+            async with AsyncSessionLocal() as session:
+                row = (await session.execute(
+                    select(FSMState.state, FSMState.data).where(
+                        FSMState.key == k, FSMState.expires_at > datetime.utcnow()
+                    )
+                )).first()
+            if not entry.state_loaded:
+                entry.state = row.state if row else None
+                entry.state_loaded = True
+            if not entry.data_loaded:
+                entry.data = dict(row.data) if row and row.data else {}
+                entry.data_loaded = True
+        return entry
+
+    async def set_state(self, bot, key, state=None) -> None:
+        entry = await self._entry(key)
+        entry.state = state.state if isinstance(state, State) else state
+        entry.state_loaded = entry.state_dirty = True
+
+    async def get_state(self, bot, key):
+        # Читаем состояние и данные одним запросом - данные почти всегда нужны следом
+        return (await self._entry(key, need_state=True, need_data=True)).state
+
+    async def set_data(self, bot, key, data) -> None:
+        entry = await self._entry(key)
+        entry.data = dict(data)
+        entry.data_loaded = entry.data_dirty = True
+
+    async def get_data(self, bot, key):
+        return dict((await self._entry(key, need_state=True, need_data=True)).data)
+
+    async def flush(self):
+        """Записать изменения текущего апдейта: не больше одного upsert на вид изменения."""
+        entries = _pending.get()
+        _pending.set(None)
+        if not entries:
+            return
+        expires_at = datetime.utcnow() + self.ttl
+        groups = {}
+        for k, entry in entries.items():
+            if entry.state_dirty or entry.data_dirty:
+                groups.setdefault((entry.state_dirty, entry.data_dirty), []).append((k, entry))
+        if not groups:
+            return
+        async with AsyncSessionLocal() as session:
+            for (state_dirty, data_dirty), items in groups.items():
+                stmt = insert(FSMState).values([
+                    {"key": k, "state": e.state, "data": e.data, "expires_at": expires_at}
+                    for k, e in items
+                ])
+                update = {"expires_at": stmt.excluded.expires_at}
+                if state_dirty:
+                    update["state"] = stmt.excluded.state
+                if data_dirty:
+                    update["data"] = stmt.excluded.data
+                await session.execute(stmt.on_conflict_do_update(index_elements=[FSMState.key], set_=update))
+            await session.commit()
+
+    async def close(self) -> None:
+        # Буферов между апдейтами нет: каждый апдейт записывает свои изменения сам
+        pass
+
+async def delete_expired_states() -> int:
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(delete(FSMState).where(FSMState.expires_at <= datetime.utcnow()))
+        await session.commit()
+    return result.rowcount
+
+def create_storage():
+    if FSM_STORAGE == "postgres":
+        return PostgresStorage()
+    if FSM_STORAGE == "redis":
+        # Любой Redis-совместимый сервер (Redis, KeyDB, Dragonfly)
+        from aiogram.fsm.storage.redis import RedisStorage
+        return RedisStorage.from_url(REDIS_URL, state_ttl=FSM_TTL, data_ttl=FSM_TTL)
+    return MemoryStorage()
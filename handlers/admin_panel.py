@@ -1,14 +1,19 @@
 from aiogram import Router, F
-from aiogram.types import CallbackQuery, Message
+from aiogram.types import CallbackQuery, Message, FSInputFile
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
-from db import AsyncSessionLocal
-from models import User, Department, RoleEnum, Task, TaskStatusEnum
+from sqlalchemy.ext.asyncio import AsyncSession
+from models import User, Department, RoleEnum
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from sqlalchemy import select, func
-import openpyxl
-from io import BytesIO
-from keyboards import main_menu
+import os
+from keyboards import main_menu, admin_menu, admin_stats_keyboard, department_page_keyboard
+from refdata import refdata
+from leaderboard import leaderboard
+import stats
+from cache import CachedUser
+from export import build_export
+from pagination import fetch_page, page_keyboard, parse_page, truncate_bytes, MAX_ARG_BYTES
 
 router = Router()
 
@@ -22,17 +27,18 @@ class DeptCreateFSM(StatesGroup):
 class AssignManagerFSM(StatesGroup):
     waiting_for_user_id = State()
 
-@router.callback_query(F.data == "admin:departments")
-async def admin_departments_menu(query: CallbackQuery):
-    async with AsyncSessionLocal() as session:
-        depts = (await session.execute(select(Department))).scalars().all()
-    kb = InlineKeyboardBuilder()
-    for d in depts:
-        kb.button(text=f"{d.name}", callback_data=f"admin:dept:{d.id}")
-    kb.button(text="➕ Добавить отдел", callback_data="admin:add_department")
-    kb.button(text="⬅️ Назад", callback_data="admin:main_menu")
-    kb.adjust(1)
-    await query.message.edit_text("Управление отделами:", reply_markup=kb.as_markup())
+class UserSearchFSM(StatesGroup):
+    waiting_for_prefix = State()
+
+# Состояния админских диалогов - доступ к ним проверяет AuthMiddleware
+ADMIN_STATES = tuple(
+    f"{group.__name__}:" for group in (DeptRenameFSM, DeptCreateFSM, AssignManagerFSM, UserSearchFSM)
+)
+
+@router.callback_query((F.data == "admin:departments") | F.data.startswith("admin:departments:"))
+async def admin_departments_menu(query: CallbackQuery, session: AsyncSession):
+    direction, key, _ = parse_page(query.data, "admin:departments")
+    await show_departments_menu(query, session, direction, key)
 
 @router.callback_query(F.data == "admin:add_department")
 async def add_department_start(query: CallbackQuery, state: FSMContext):
@@ -40,49 +46,45 @@ async def add_department_start(query: CallbackQuery, state: FSMContext):
     await state.set_state(DeptCreateFSM.waiting_for_name)
 
 @router.message(F.text, DeptCreateFSM.waiting_for_name)
-async def add_department_name(message: Message, state: FSMContext):
+async def add_department_name(message: Message, state: FSMContext, session: AsyncSession):
     name = message.text.strip()
-    async with AsyncSessionLocal() as session:
-        existing = (await session.execute(select(Department).where(Department.name == name))).scalar_one_or_none()
-        if existing:
-            await message.answer("Отдел с таким названием уже существует, попробуйте другое имя.")
-            return
-        dept = Department(name=name)
-        session.add(dept)
-        await session.commit()
-        await message.answer(f"Отдел '{name}' создан.")
+    existing = (await session.execute(select(Department).where(Department.name == name))).scalar_one_or_none()
+    if existing:
+        await message.answer("Отдел с таким названием уже существует, попробуйте другое имя.")
+        return
+    dept = Department(name=name)
+    session.add(dept)
+    await session.commit()
+    await refdata.changed("departments")
+    await message.answer(f"Отдел '{name}' создан.")
     await state.clear()
-    await show_departments_menu(message)
+    await show_departments_menu(message, session)
 
-async def show_departments_menu(message_or_query):
-    async with AsyncSessionLocal() as session:
-        depts = (await session.execute(select(Department))).scalars().all()
-    kb = InlineKeyboardBuilder()
-    for d in depts:
-        kb.button(text=f"{d.name}", callback_data=f"admin:dept:{d.id}")
-    kb.button(text="➕ Добавить отдел", callback_data="admin:add_department")
-    kb.button(text="⬅️ Назад", callback_data="admin:main_menu")
-    kb.adjust(1)
+async def show_departments_menu(message_or_query, session: AsyncSession, direction="n", key=None):
+    kb = await department_page_keyboard(
+        session, "admin:departments", "admin:dept:", direction, key,
+        extra=[("➕ Добавить отдел", "admin:add_department")],
+        back="admin:main_menu",
+    )
     if hasattr(message_or_query, "message"):
-        await message_or_query.message.edit_text("Управление отделами:", reply_markup=kb.as_markup())
+        await message_or_query.message.edit_text("Управление отделами:", reply_markup=kb)
     else:
-        await message_or_query.answer("Управление отделами:", reply_markup=kb.as_markup())
+        await message_or_query.answer("Управление отделами:", reply_markup=kb)
 
 @router.callback_query(F.data.startswith("admin:dept:"))
-async def dept_detail_menu(query: CallbackQuery):
+async def dept_detail_menu(query: CallbackQuery, session: AsyncSession):
     dept_id = int(query.data.split(":")[-1])
-    async with AsyncSessionLocal() as session:
-        dept = await session.get(Department, dept_id)
-    if not dept:
+    name = (await refdata.departments(session)).get(dept_id)
+    if name is None:
         await query.answer("Отдел не найден", show_alert=True)
         return
     kb = InlineKeyboardBuilder()
-    kb.button(text="✏️ Переименовать", callback_data=f"admin:dept_rename:{dept.id}")
-    kb.button(text="🗑 Удалить", callback_data=f"admin:dept_delete:{dept.id}")
-    kb.button(text="👔 Назначить руководителя", callback_data=f"admin:dept_assign_manager:{dept.id}")
+    kb.button(text="✏️ Переименовать", callback_data=f"admin:dept_rename:{dept_id}")
+    kb.button(text="🗑 Удалить", callback_data=f"admin:dept_delete:{dept_id}")
+    kb.button(text="👔 Назначить руководителя", callback_data=f"admin:dept_assign_manager:{dept_id}")
     kb.button(text="⬅️ Назад", callback_data="admin:departments")
     kb.adjust(1)
-    await query.message.edit_text(f"Отдел: {dept.name}", reply_markup=kb.as_markup())
+    await query.message.edit_text(f"Отдел: {name}", reply_markup=kb.as_markup())
 
 @router.callback_query(F.data.startswith("admin:dept_rename:"))
 async def dept_rename_start(query: CallbackQuery, state: FSMContext):
@@ -92,26 +94,26 @@ async def dept_rename_start(query: CallbackQuery, state: FSMContext):
     await state.set_state(DeptRenameFSM.waiting_for_new_name)
 
 @router.message(F.text, DeptRenameFSM.waiting_for_new_name)
-async def dept_rename_save(message: Message, state: FSMContext):
+async def dept_rename_save(message: Message, state: FSMContext, session: AsyncSession):
     data = await state.get_data()
     dept_id = data.get("dept_id")
     new_name = message.text.strip()
-    async with AsyncSessionLocal() as session:
-        existing = (await session.execute(select(Department).where(Department.name == new_name))).scalar_one_or_none()
-        if existing:
-            await message.answer("Отдел с таким названием уже существует, попробуйте другое имя.")
-            return
-        dept = await session.get(Department, dept_id)
-        if not dept:
-            await message.answer("Отдел не найден.")
-            await state.clear()
-            return
-        dept.name = new_name
-        session.add(dept)
-        await session.commit()
-        await message.answer(f"Отдел переименован в '{new_name}'.")
+    existing = (await session.execute(select(Department).where(Department.name == new_name))).scalar_one_or_none()
+    if existing:
+        await message.answer("Отдел с таким названием уже существует, попробуйте другое имя.")
+        return
+    dept = await session.get(Department, dept_id)
+    if not dept:
+        await message.answer("Отдел не найден.")
+        await state.clear()
+        return
+    dept.name = new_name
+    session.add(dept)
+    await session.commit()
+    await refdata.changed("departments")
+    await message.answer(f"Отдел переименован в '{new_name}'.")
     await state.clear()
-    await show_departments_menu(message)
+    await show_departments_menu(message, session)
 
 @router.callback_query(F.data.startswith("admin:dept_delete:"))
 async def dept_delete_confirm(query: CallbackQuery):
@@ -123,17 +125,21 @@ async def dept_delete_confirm(query: CallbackQuery):
     await query.message.edit_text("Вы уверены, что хотите удалить отдел? Все пользователи и задачи отдела будут затронуты.", reply_markup=kb.as_markup())
 
 @router.callback_query(F.data.startswith("admin:dept_delete_confirm:"))
-async def dept_delete(query: CallbackQuery):
+async def dept_delete(query: CallbackQuery, session: AsyncSession):
     dept_id = int(query.data.split(":")[-1])
-    async with AsyncSessionLocal() as session:
-        dept = await session.get(Department, dept_id)
-        if not dept:
-            await query.answer("Отдел не найден", show_alert=True)
-            return
-        await session.delete(dept)
-        await session.commit()
+    dept = await session.get(Department, dept_id)
+    if not dept:
+        await query.answer("Отдел не найден", show_alert=True)
+        return
+    # У сотрудников отдела department_id обнулится - их записи в кэше пользователей устареют
+    member_ids = (await session.execute(select(User.id).where(User.department_id == dept_id))).scalars().all()
+    await session.delete(dept)
+    await session.commit()
+    await refdata.changed("departments", "managers")
+    await refdata.user_changed(*member_ids)
+    leaderboard.drop_department(dept_id)
     await query.answer("Отдел удалён")
-    await show_departments_menu(query)
+    await show_departments_menu(query, session)
 
 # --- Назначение руководителя ---
 
@@ -145,7 +151,7 @@ async def assign_manager_start(query: CallbackQuery, state: FSMContext):
     await state.set_state(AssignManagerFSM.waiting_for_user_id)
 
 @router.message(F.text, AssignManagerFSM.waiting_for_user_id)
-async def assign_manager_confirm(message: Message, state: FSMContext):
+async def assign_manager_confirm(message: Message, state: FSMContext, session: AsyncSession):
     data = await state.get_data()
     dept_id = data.get("dept_id")
     try:
@@ -153,37 +159,68 @@ async def assign_manager_confirm(message: Message, state: FSMContext):
     except ValueError:
         await message.answer("Введите корректный числовой Telegram ID.")
         return
-    async with AsyncSessionLocal() as session:
-        user = await session.get(User, user_id)
-        if not user:
-            await message.answer("Пользователь с таким ID не найден.")
-            return
-        user.role = RoleEnum.manager
-        user.department_id = dept_id
-        session.add(user)
-        await session.commit()
-        await message.answer(f"Пользователь {user.username or user.id} назначен руководителем отдела.")
+    user = await session.get(User, user_id)
+    if not user:
+        await message.answer("Пользователь с таким ID не найден.")
+        return
+    # Баллы пользователя переходят вместе с ним в новый отдел
+    delta = stats.StatsDelta()
+    delta.add_points(user.department_id, -user.points)
+    delta.add_points(dept_id, user.points)
+    user.role = RoleEnum.manager
+    user.department_id = dept_id
+    session.add(user)
+    await delta.apply(session)
+    await session.commit()
+    await refdata.user_changed(user.id)
+    await refdata.changed("managers")
+    leaderboard.upsert(user.id, user.username, user.points, user.department_id, user.is_active)
+    await message.answer(f"Пользователь {user.username or user.id} назначен руководителем отдела.")
     await state.clear()
-    await show_departments_menu(message)
+    await show_departments_menu(message, session)
 
 # --- Управление пользователями ---
 
-@router.callback_query(F.data == "admin:users")
-async def admin_users_menu(query: CallbackQuery):
-    async with AsyncSessionLocal() as session:
-        users = (await session.execute(select(User))).scalars().all()
-    kb = InlineKeyboardBuilder()
-    for u in users:
-        kb.button(text=f"{u.username or u.id} [{u.role.value}]", callback_data=f"admin:user:{u.id}")
-    kb.button(text="⬅️ Назад", callback_data="admin:main_menu")
-    kb.adjust(1)
-    await query.message.edit_text("Управление пользователями:", reply_markup=kb.as_markup())
+async def show_users_menu(message_or_query, session: AsyncSession, direction="n", key=None, prefix=""):
+    filters = [func.lower(User.username).startswith(prefix.lower(), autoescape=True)] if prefix else []
+    page = await fetch_page(session, User.id, [User.username, User.role], filters, direction, key)
+    kb = page_keyboard(
+        page,
+        lambda u: (f"{u.username or u.id} [{u.role.value}]", f"admin:user:{u.id}"),
+        "admin:users",
+        arg=prefix,
+        extra=[("🔍 Поиск по имени", "admin:users_search")],
+        back="admin:main_menu",
+    )
+    title = f"Пользователи на '{prefix}':" if prefix else "Управление пользователями:"
+    if not page.rows:
+        title = "Пользователи не найдены."
+    if hasattr(message_or_query, "message"):
+        await message_or_query.message.edit_text(title, reply_markup=kb)
+    else:
+        await message_or_query.answer(title, reply_markup=kb)
+
+@router.callback_query((F.data == "admin:users") | F.data.startswith("admin:users:"))
+async def admin_users_menu(query: CallbackQuery, session: AsyncSession):
+    direction, key, prefix = parse_page(query.data, "admin:users")
+    await show_users_menu(query, session, direction, key, prefix)
+
+@router.callback_query(F.data == "admin:users_search")
+async def users_search_start(query: CallbackQuery, state: FSMContext):
+    await query.message.edit_text("Введите начало имени пользователя:")
+    await state.set_state(UserSearchFSM.waiting_for_prefix)
+
+@router.message(F.text, UserSearchFSM.waiting_for_prefix)
+async def users_search(message: Message, state: FSMContext, session: AsyncSession):
+    # ":" зарезервировано под разметку callback_data
+    prefix = truncate_bytes(message.text.strip().lstrip("@").replace(":", ""), MAX_ARG_BYTES)
+    await state.clear()
+    await show_users_menu(message, session, prefix=prefix)
 
 @router.callback_query(F.data.startswith("admin:user:"))
-async def user_detail_menu(query: CallbackQuery):
+async def user_detail_menu(query: CallbackQuery, session: AsyncSession):
     user_id = int(query.data.split(":")[-1])
-    async with AsyncSessionLocal() as session:
-        user = await session.get(User, user_id)
+    user = await session.get(User, user_id)
     if not user:
         await query.answer("Пользователь не найден", show_alert=True)
         return
@@ -197,21 +234,25 @@ async def user_detail_menu(query: CallbackQuery):
     await query.message.edit_text(f"Пользователь: {user.username or user.id}\nРоль: {user.role.value}\nАктивен: {user.is_active}", reply_markup=kb.as_markup())
 
 @router.callback_query(F.data.startswith("admin:user_toggle_active:"))
-async def toggle_user_active(query: CallbackQuery):
+async def toggle_user_active(query: CallbackQuery, session: AsyncSession):
     user_id = int(query.data.split(":")[-1])
-    async with AsyncSessionLocal() as session:
-        user = await session.get(User, user_id)
-        if not user:
-            await query.answer("Пользователь не найден", show_alert=True)
-            return
-        user.is_active = not user.is_active
-        session.add(user)
-        await session.commit()
-        await query.answer(f"Активность изменена: {user.is_active}")
-    await user_detail_menu(query)
+    user = await session.get(User, user_id)
+    if not user:
+        await query.answer("Пользователь не найден", show_alert=True)
+        return
+    user.is_active = not user.is_active
+    session.add(user)
+    await session.commit()
+    await refdata.user_changed(user.id)
+    leaderboard.upsert(user.id, user.username, user.points, user.department_id, user.is_active)
+    if user.role == RoleEnum.manager:
+        # Руководителем отдела считается только активный пользователь
+        await refdata.changed("managers")
+    await query.answer(f"Активность изменена: {user.is_active}")
+    await user_detail_menu(query, session)
 
 @router.callback_query(F.data.startswith("admin:user_role_"))
-async def change_user_role(query: CallbackQuery):
+async def change_user_role(query: CallbackQuery, session: AsyncSession):
     parts = query.data.split(":")
     role_str = parts[1].split("_")[-1]
     user_id = int(parts[-1])
@@ -219,104 +260,71 @@ async def change_user_role(query: CallbackQuery):
         await query.answer("Неверная роль", show_alert=True)
         return
     new_role = RoleEnum(role_str)
-    async with AsyncSessionLocal() as session:
-        user = await session.get(User, user_id)
-        if not user:
-            await query.answer("Пользователь не найден", show_alert=True)
-            return
-        user.role = new_role
-        session.add(user)
-        await session.commit()
-        await query.answer(f"Роль изменена на {new_role.value}")
-    await user_detail_menu(query)
+    user = await session.get(User, user_id)
+    if not user:
+        await query.answer("Пользователь не найден", show_alert=True)
+        return
+    old_role = user.role
+    user.role = new_role
+    session.add(user)
+    await session.commit()
+    await refdata.user_changed(user.id)
+    if RoleEnum.manager in (old_role, new_role):
+        await refdata.changed("managers")
+    await query.answer(f"Роль изменена на {new_role.value}")
+    await user_detail_menu(query, session)
 
 # --- Админ главное меню ---
 
 @router.callback_query(F.data == "admin:main_menu")
 async def admin_main_menu(query: CallbackQuery):
-    kb = InlineKeyboardBuilder()
-    kb.button(text="👥 Пользователи", callback_data="admin:users")
-    kb.button(text="🏢 Отделы", callback_data="admin:departments")
-    kb.button(text="📊 Статистика", callback_data="admin:stats")
-    kb.button(text="📥 Выгрузка статистики (XLSX)", callback_data="admin:export_stats")
-    kb.adjust(1)
-    await query.message.edit_text("Админ меню:", reply_markup=kb.as_markup())
+    await query.message.edit_text("Админ меню:", reply_markup=admin_menu())
 # --- Статистика ---
 
 async def calculate_stats(session, user=None, department=None):
     """
     Возвращает словарь статистики:
     - points
+    - penalties (списано штрафами; для пользователя)
     - total_tasks
     - avg_time_hours (только для принятых задач)
+    Агрегация выполняется в БД (см. stats.py).
     """
-    filters = []
     if user:
-        filters.append(Task.assigned_to == user.id)
+        result = await stats.user_stats(session, user_ids=[user.id])
+        return result.get(user.id) or stats.make_stats(0, 0, None)
     if department:
-        filters.append(Task.department_id == department.id)
-
-    # Очки пользователя (для user) или суммы очков по отделу (для department) считаем отдельно
-    if user:
-        points = user.points
-    elif department:
-        users_in_dept = (await session.execute(select(User.points).where(User.department_id == department.id))).scalars().all()
-        points = sum(users_in_dept)
-    else:
-        points = None
-
-    q = select(Task).where(*filters) if filters else select(Task)
-    tasks = (await session.execute(q)).scalars().all()
-
-    total_tasks = len(tasks)
-
-    # Среднее время выполнения (от взятия задачи до сдачи = от in_progress до done)
-    times = []
-    for task in tasks:
-        if task.status == TaskStatusEnum.done or task.status == TaskStatusEnum.escalated or task.status == TaskStatusEnum.overdue:
-            # Берем разницу между created_at и updated_at, как упрощение
-            delta = (task.updated_at - task.created_at).total_seconds()
-            if delta > 0:
-                times.append(delta)
-    avg_time_hours = round(sum(times)/len(times)/3600, 2) if times else 0
-
-    return {
-        "points": points if points is not None else 0,
-        "total_tasks": total_tasks,
-        "avg_time_hours": avg_time_hours
-    }
+        result = await stats.department_stats(session, department_ids=[department.id])
+        return result.get(department.id) or stats.make_stats(0, 0, None)
+    return await stats.overall_stats(session)
 
 @router.callback_query(F.data == "stats:personal")
-async def personal_stats(callback: CallbackQuery):
-    user_id = callback.from_user.id
-    async with AsyncSessionLocal() as session:
-        user = await session.get(User, user_id)
-        if not user or not user.is_active:
-            await callback.answer("Вы не зарегистрированы или не активны", show_alert=True)
-            return
-        stats = await calculate_stats(session, user=user)
+async def personal_stats(callback: CallbackQuery, session: AsyncSession, user: CachedUser):
+    if not user or not user.is_active:
+        await callback.answer("Вы не зарегистрированы или не активны", show_alert=True)
+        return
+    stats = await calculate_stats(session, user=user)
     text = (
         f"📊 Ваша статистика:\n"
         f"Баллы: {stats['points']}\n"
+        f"Штрафы: {stats['penalties']}\n"
         f"Всего задач: {stats['total_tasks']}\n"
         f"Среднее время выполнения: {stats['avg_time_hours']} ч."
     )
     await callback.message.edit_text(text, reply_markup=main_menu(user.role))
 
 @router.callback_query(F.data == "stats:department")
-async def department_stats(callback: CallbackQuery):
-    user_id = callback.from_user.id
-    async with AsyncSessionLocal() as session:
-        user = await session.get(User, user_id)
-        if not user or user.role not in [RoleEnum.manager, RoleEnum.admin] or not user.is_active:
-            await callback.answer("Доступ запрещён", show_alert=True)
-            return
-        if not user.department:
-            await callback.answer("Вы не привязаны к отделу", show_alert=True)
-            return
-        stats = await calculate_stats(session, department=user.department)
+async def department_stats(callback: CallbackQuery, session: AsyncSession, user: CachedUser):
+    if not user or user.role not in [RoleEnum.manager, RoleEnum.admin] or not user.is_active:
+        await callback.answer("Доступ запрещён", show_alert=True)
+        return
+    department = await session.get(Department, user.department_id) if user.department_id else None
+    if not department:
+        await callback.answer("Вы не привязаны к отделу", show_alert=True)
+        return
+    stats = await calculate_stats(session, department=department)
     text = (
-        f"📊 Статистика отдела '{user.department.name}':\n"
+        f"📊 Статистика отдела '{department.name}':\n"
         f"Баллы: {stats['points']}\n"
         f"Всего задач: {stats['total_tasks']}\n"
         f"Среднее время выполнения: {stats['avg_time_hours']} ч."
@@ -325,79 +333,44 @@ async def department_stats(callback: CallbackQuery):
 
 @router.callback_query(F.data == "stats:admin")
 async def admin_stats_menu(callback: CallbackQuery):
-    kb = InlineKeyboardBuilder()
-    kb.button(text="📊 Статистика по отделам", callback_data="stats:admin:departments")
-    kb.button(text="📊 Статистика по пользователям", callback_data="stats:admin:users")
-    kb.button(text="📥 Выгрузить статистику в XLSX", callback_data="stats:admin:export")
-    kb.button(text="⬅️ Назад", callback_data="main_menu")
-    kb.adjust(1)
-    await callback.message.edit_text("Админская статистика:", reply_markup=kb.as_markup())
+    await callback.message.edit_text("Админская статистика:", reply_markup=admin_stats_keyboard())
 
 @router.callback_query(F.data == "stats:admin:departments")
-async def admin_stats_departments(callback: CallbackQuery):
-    async with AsyncSessionLocal() as session:
-        departments = (await session.execute(select(Department))).scalars().all()
-        text_lines = []
-        for d in departments:
-            stats = await calculate_stats(session, department=d)
-            text_lines.append(f"{d.name}:\n Баллы: {stats['points']}, Задач: {stats['total_tasks']}, Среднее время: {stats['avg_time_hours']} ч.")
-        text = "📊 Статистика по отделам:\n\n" + "\n\n".join(text_lines)
+async def admin_stats_departments(callback: CallbackQuery, session: AsyncSession):
+    departments = await refdata.departments(session)
+    dept_stats = await stats.department_stats(session)
+    text_lines = []
+    for dept_id, name in departments.items():
+        s = dept_stats.get(dept_id) or stats.make_stats(0, 0, None)
+        text_lines.append(f"{name}:\n Баллы: {s['points']}, Задач: {s['total_tasks']}, Среднее время: {s['avg_time_hours']} ч.")
+    text = "📊 Статистика по отделам:\n\n" + "\n\n".join(text_lines)
     await callback.message.edit_text(text, reply_markup=main_menu(RoleEnum.admin))
 
 @router.callback_query(F.data == "stats:admin:users")
-async def admin_stats_users(callback: CallbackQuery):
-    async with AsyncSessionLocal() as session:
-        users = (await session.execute(select(User).where(User.is_active == True))).scalars().all()
-        text_lines = []
-        for u in users:
-            stats = await calculate_stats(session, user=u)
-            text_lines.append(f"{u.username or u.id}:\n Баллы: {stats['points']}, Задач: {stats['total_tasks']}, Среднее время: {stats['avg_time_hours']} ч.")
-        text = "📊 Статистика по пользователям:\n\n" + "\n\n".join(text_lines)
+async def admin_stats_users(callback: CallbackQuery, session: AsyncSession):
+    users = (await session.execute(select(User).where(User.is_active == True))).scalars().all()
+    users_stats = await stats.user_stats(session, user_ids=[u.id for u in users])
+    text_lines = []
+    for u in users:
+        s = users_stats.get(u.id) or stats.make_stats(u.points, 0, None)
+        text_lines.append(f"{u.username or u.id}:\n Баллы: {s['points']}, Задач: {s['total_tasks']}, Среднее время: {s['avg_time_hours']} ч.")
+    text = "📊 Статистика по пользователям:\n\n" + "\n\n".join(text_lines)
     await callback.message.edit_text(text, reply_markup=main_menu(RoleEnum.admin))
 
-@router.callback_query(F.data == "stats:admin:export")
-async def admin_export_stats(callback: CallbackQuery):
-    async with AsyncSessionLocal() as session:
-        users = (await session.execute(select(User).where(User.is_active == True))).scalars().all()
-        departments = (await session.execute(select(Department))).scalars().all()
-
-        wb = openpyxl.Workbook()
-        # Лист пользователей
-        ws_users = wb.active
-        ws_users.title = "Пользователи"
-        ws_users.append(["ID", "Username", "Роль", "Отдел", "Баллы", "Всего задач", "Среднее время (ч)"])
-
-        for u in users:
-            stats = await calculate_stats(session, user=u)
-            ws_users.append([
-                u.id,
-                u.username or "",
-                u.role.value,
-                u.department.name if u.department else "",
-                stats['points'],
-                stats['total_tasks'],
-                stats['avg_time_hours']
-            ])
-
-        # Лист отделов
-        ws_depts = wb.create_sheet("Отделы")
-        ws_depts.append(["ID", "Название", "Баллы", "Всего задач", "Среднее время (ч)"])
-        for d in departments:
-            stats = await calculate_stats(session, department=d)
-            ws_depts.append([
-                d.id,
-                d.name,
-                stats['points'],
-                stats['total_tasks'],
-                stats['avg_time_hours']
-            ])
-
-        bio = BytesIO()
-        wb.save(bio)
-        bio.seek(0)
-
+@router.callback_query(F.data.startswith("stats:admin:export"))
+async def admin_export_stats(callback: CallbackQuery, session: AsyncSession):
+    # stats:admin:export[:xlsx|csv][:tasks]
+    options = callback.data.split(":")[3:]
+    fmt = "csv" if "csv" in options else "xlsx"
+    include_tasks = "tasks" in options
+    await callback.answer("Готовлю выгрузку...")
+    path, filename = await build_export(session, fmt=fmt, include_tasks=include_tasks)
+    # Отдаём соединение в пул до загрузки файла (сессия больше не нужна)
+    await session.close()
+    try:
         await callback.message.answer_document(
-            document=bio,
-            filename="statistics.xlsx",
+            document=FSInputFile(path, filename=filename),
             caption="Выгрузка статистики"
         )
+    finally:
+        os.remove(path)
@@ -0,0 +1,43 @@
+from aiogram import Router, F
+from aiogram.types import CallbackQuery
+from sqlalchemy.ext.asyncio import AsyncSession
+from cache import CachedUser
+from keyboards import leaderboard_keyboard
+from leaderboard import leaderboard
+from refdata import refdata
+
+router = Router()
+
+def _render(title, places, my_place, user):
+    lines = [title, ""]
+    if not places:
+        lines.append("Пока никого нет.")
+    for place in places:
+        name = place.username or place.user_id
+        mark = " ⬅️" if place.user_id == user.id else ""
+        lines.append(f"{place.rank}. {name} - {place.points}{mark}")
+    if my_place:
+        rank, total = my_place
+        lines += ["", f"Ваше место: {rank} из {total}"]
+    return "\n".join(lines)
+
+@router.callback_query(F.data == "leaderboard")
+async def leaderboard_global(callback: CallbackQuery, user: CachedUser):
+    if not user or not user.is_active:
+        await callback.answer("Вы не зарегистрированы или не активны", show_alert=True)
+        return
+    text = _render("🏆 Общий рейтинг:", leaderboard.top(), leaderboard.rank(user.id), user)
+    await callback.message.edit_text(text, reply_markup=leaderboard_keyboard())
+
+@router.callback_query(F.data == "leaderboard:department")
+async def leaderboard_department(callback: CallbackQuery, session: AsyncSession, user: CachedUser):
+    if not user or not user.is_active:
+        await callback.answer("Вы не зарегистрированы или не активны", show_alert=True)
+        return
+    if not user.department_id:
+        await callback.answer("Вы не привязаны к отделу", show_alert=True)
+        return
+    name = (await refdata.departments(session)).get(user.department_id, user.department_id)
+    places = leaderboard.top(department_id=user.department_id)
+    text = _render(f"🏆 Рейтинг отдела '{name}':", places, leaderboard.rank(user.id, user.department_id), user)
+    await callback.message.edit_text(text, reply_markup=leaderboard_keyboard())
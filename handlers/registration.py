@@ -2,33 +2,37 @@ from aiogram import Router, F
 from aiogram.filters import CommandStart
 from aiogram.types import Message
 from models import User, RoleEnum
-from db import AsyncSessionLocal
-from bot_instance import bot
+from sqlalchemy.ext.asyncio import AsyncSession
+from notifications import outbox
+from cache import user_cache, CachedUser
+from leaderboard import leaderboard
+import logging
 import os
 
+logger = logging.getLogger(__name__)
 router = Router()
 ADMIN_ID = int(os.getenv("ADMIN_ID"))
 
 @router.message(CommandStart())
-async def cmd_start(message: Message):
-    logger.debug("Start command received")  # Логирование, чтобы увидеть, что команда запускается
-    async with AsyncSessionLocal() as session:
-        user = await session.get(User, message.from_user.id)
-        if not user:
-            new_user = User(
-                id=message.from_user.id,
-                username=message.from_user.username,
-                is_active=False,
-                role=RoleEnum.employee
-            )
-            session.add(new_user)
-            await session.commit()
-            await message.answer("Добро пожаловать! Ждите одобрения администратора.")
-            await bot.send_message(ADMIN_ID, f"Новый пользователь @{message.from_user.username} ({message.from_user.id}) ожидает одобрения.")
+async def cmd_start(message: Message, session: AsyncSession, user: CachedUser):
+    logger.debug("Start command received")
+    if not user:
+        new_user = User(
+            id=message.from_user.id,
+            username=message.from_user.username,
+            is_active=False,
+            role=RoleEnum.employee
+        )
+        session.add(new_user)
+        await session.commit()
+        user_cache.invalidate(new_user.id)
+        leaderboard.upsert(new_user.id, new_user.username, new_user.points, new_user.department_id, new_user.is_active)
+        await message.answer("Добро пожаловать! Ждите одобрения администратора.")
+        await outbox.send(ADMIN_ID, f"Новый пользователь @{message.from_user.username} ({message.from_user.id}) ожидает одобрения.")
+    else:
+        if user.is_active:
+            from keyboards import main_menu
+            kb = main_menu(user.role)
+            await message.answer("Вы уже зарегистрированы.", reply_markup=kb)
         else:
-            if user.is_active:
-                from keyboards import main_menu
-                kb = main_menu(user.role)
-                await message.answer("Вы уже зарегистрированы.", reply_markup=kb)
-            else:
-                await message.answer("Ваша регистрация ещё не подтверждена администратором.")
+            await message.answer("Ваша регистрация ещё не подтверждена администратором.")
@@ -2,11 +2,15 @@ from aiogram import Router, F
 from aiogram.types import CallbackQuery, Message
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
-from db import AsyncSessionLocal
-from models import Task, TaskStatusEnum, User, Department
-from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from models import Task, TaskStatusEnum, User
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from datetime import datetime
+import stats
+from events import task_events
+from deadlines import deadlines, NEW_TASK_DEADLINE, REVIEW_DEADLINE
+from pagination import fetch_page, page_keyboard, parse_page
+from keyboards import department_page_keyboard
 
 router = Router()
 
@@ -15,15 +19,11 @@ class NewTaskFSM(StatesGroup):
     waiting_for_title = State()
     waiting_for_description = State()
 
-@router.callback_query(F.data == "tasks:new")
-async def new_task_start(query: CallbackQuery, state: FSMContext):
-    async with AsyncSessionLocal() as session:
-        depts = (await session.execute(select(Department))).scalars().all()
-    kb = InlineKeyboardBuilder()
-    for d in depts:
-        kb.button(text=d.name, callback_data=f"task:new:dept:{d.id}")
-    kb.adjust(1)
-    await query.message.edit_text("Выберите отдел:", reply_markup=kb.as_markup())
+@router.callback_query((F.data == "tasks:new") | F.data.startswith("tasks:new:"))
+async def new_task_start(query: CallbackQuery, state: FSMContext, session: AsyncSession):
+    direction, key, _ = parse_page(query.data, "tasks:new")
+    kb = await department_page_keyboard(session, "tasks:new", "task:new:dept:", direction, key)
+    await query.message.edit_text("Выберите отдел:", reply_markup=kb)
     await state.set_state(NewTaskFSM.waiting_for_department)
 
 @router.callback_query(F.data.startswith("task:new:dept:"))
@@ -40,52 +40,53 @@ async def get_task_title(message: Message, state: FSMContext):
     await state.set_state(NewTaskFSM.waiting_for_description)
 
 @router.message(NewTaskFSM.waiting_for_description)
-async def get_task_description(message: Message, state: FSMContext):
+async def get_task_description(message: Message, state: FSMContext, session: AsyncSession):
     data = await state.get_data()
     description = message.text.strip()
     dept_id = data.get("department_id")
     title = data.get("title")
     user_id = message.from_user.id
+    now = datetime.utcnow()
 
-    async with AsyncSessionLocal() as session:
-        task = Task(
-            title=title,
-            description=description,
-            status=TaskStatusEnum.new,
-            created_at=datetime.utcnow(),
-            updated_at=datetime.utcnow(),
-            department_id=dept_id,
-            issued_by=user_id
-        )
-        session.add(task)
-        await session.commit()
+    task = Task(
+        title=title,
+        description=description,
+        status=TaskStatusEnum.new,
+        created_at=now,
+        updated_at=now,
+        due_at=now + NEW_TASK_DEADLINE,
+        department_id=dept_id,
+        issued_by=user_id
+    )
+    session.add(task)
+    await stats.record_task_change(session, None, stats.task_contribution(task))
+    await session.commit()
+    task_events.record(task.id, TaskStatusEnum.new, user_id=user_id, at=task.created_at)
+    deadlines.schedule(task.id, task.due_at)
     await message.answer("Задача создана и ожидает принятия.")
     await state.clear()
 
-@router.callback_query(F.data == "tasks:my")
-async def my_tasks_menu(query: CallbackQuery):
+@router.callback_query((F.data == "tasks:my") | F.data.startswith("tasks:my:"))
+async def my_tasks_menu(query: CallbackQuery, session: AsyncSession):
     user_id = query.from_user.id
-    async with AsyncSessionLocal() as session:
-        tasks = (await session.execute(
-            select(Task).where(Task.assigned_to == user_id, Task.status.in_([TaskStatusEnum.in_progress, TaskStatusEnum.submitted]))
-        )).scalars().all()
+    direction, key, _ = parse_page(query.data, "tasks:my")
+    page = await fetch_page(
+        session, Task.id, [Task.title, Task.status],
+        [Task.assigned_to == user_id, Task.status.in_([TaskStatusEnum.in_progress, TaskStatusEnum.submitted])],
+        direction, key,
+    )
 
-    if not tasks:
+    if not page.rows:
         await query.message.edit_text("У вас нет активных задач.")
         return
 
-    kb = InlineKeyboardBuilder()
-    for task in tasks:
-        kb.button(text=f"{task.title} [{task.status.value}]", callback_data=f"task:my:{task.id}")
-    kb.button(text="⬅️ Назад", callback_data="main_menu")
-    kb.adjust(1)
-    await query.message.edit_text("Ваши задачи:", reply_markup=kb.as_markup())
+    kb = page_keyboard(page, lambda t: (f"{t.title} [{t.status.value}]", f"task:my:{t.id}"), "tasks:my", back="main_menu")
+    await query.message.edit_text("Ваши задачи:", reply_markup=kb)
 
 @router.callback_query(F.data.startswith("task:my:"))
-async def task_detail_my(query: CallbackQuery):
+async def task_detail_my(query: CallbackQuery, session: AsyncSession):
     task_id = int(query.data.split(":")[-1])
-    async with AsyncSessionLocal() as session:
-        task = await session.get(Task, task_id)
+    task = await session.get(Task, task_id)
     if not task:
         await query.answer("Задача не найдена", show_alert=True)
         return
@@ -102,16 +103,21 @@ async def task_detail_my(query: CallbackQuery):
     await query.message.edit_text(text, reply_markup=kb.as_markup())
 
 @router.callback_query(F.data.startswith("task:submit:"))
-async def submit_task(query: CallbackQuery):
+async def submit_task(query: CallbackQuery, session: AsyncSession):
     task_id = int(query.data.split(":")[-1])
-    async with AsyncSessionLocal() as session:
-        task = await session.get(Task, task_id)
-        if not task:
-            await query.answer("Задача не найдена", show_alert=True)
-            return
-        task.status = TaskStatusEnum.submitted
-        task.updated_at = datetime.utcnow()
-        session.add(task)
-        await session.commit()
+    task = await session.get(Task, task_id)
+    if not task:
+        await query.answer("Задача не найдена", show_alert=True)
+        return
+    before = stats.task_contribution(task)
+    old_status = task.status
+    task.status = TaskStatusEnum.submitted
+    task.updated_at = datetime.utcnow()
+    task.due_at = task.updated_at + REVIEW_DEADLINE
+    session.add(task)
+    await stats.record_task_change(session, before, stats.task_contribution(task))
+    await session.commit()
+    task_events.record(task_id, TaskStatusEnum.submitted, old_status, query.from_user.id, task.updated_at)
+    deadlines.schedule(task_id, task.due_at)
     await query.answer("Задача отправлена на проверку")
     await query.message.edit_text("Задача отправлена на проверку. Ожидайте решения.")
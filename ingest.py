@@ -0,0 +1,84 @@
+import asyncio
+import logging
+import os
+import metrics
+from logconfig import update_context
+
+logger = logging.getLogger(__name__)
+
+# sync - обрабатываем апдейт до ответа Telegram (как раньше), queue - отвечаем сразу
+WEBHOOK_MODE = os.getenv("WEBHOOK_MODE", "queue")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 8))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", 1000))
+# Сколько ждём места в переполненной очереди, прежде чем отказать (backpressure)
+WEBHOOK_QUEUE_TIMEOUT = float(os.getenv("WEBHOOK_QUEUE_TIMEOUT", 0.5))
+
+def update_key(update) -> int:
+    """Ключ упорядочивания: апдейты одного чата обрабатываются строго по порядку."""
+    event = update.event
+    chat = getattr(event, "chat", None) or getattr(getattr(event, "message", None), "chat", None)
+    if chat:
+        return chat.id
+    user = getattr(event, "from_user", None)
+    return user.id if user else update.update_id
+
+class UpdateQueue:
+    """
+    Ограниченная очередь апдейтов с пулом воркеров.
+    Каждый чат закреплён за одним воркером (шардом), поэтому его апдейты не переупорядочиваются,
+    а медленный чат тормозит только свой шард.
+    """
+
+    def __init__(self, dp, bot, workers=WEBHOOK_WORKERS, maxsize=WEBHOOK_QUEUE_SIZE, put_timeout=WEBHOOK_QUEUE_TIMEOUT):
+        self.dp = dp
+        self.bot = bot
+        self.put_timeout = put_timeout
+        self.shards = [asyncio.Queue(maxsize=max(maxsize // workers, 1)) for _ in range(workers)]
+        self.tasks = []
+        self.shed = 0
+
+    def qsize(self) -> int:
+        return sum(q.qsize() for q in self.shards)
+
+    async def submit(self, update) -> bool:
+        """Поставить апдейт в очередь. False - очередь переполнена, апдейт отброшен."""
+        shard = self.shards[update_key(update) % len(self.shards)]
+        try:
+            shard.put_nowait(update)
+            return True
+        except asyncio.QueueFull:
+            pass
+        try:
+            await asyncio.wait_for(shard.put(update), self.put_timeout)
+            return True
+        except asyncio.TimeoutError:
+            self.shed += 1
+            metrics.updates_shed.inc()
+            logger.warning("Update queue is saturated, shedding update %s", update.update_id)
+            return False
+
+    async def _worker(self, shard):
+        while True:
+            update = await shard.get()
+            try:
+                with update_context(update):
+                    try:
+                        await self.dp.feed_update(self.bot, update)
+                    except Exception:
+                        logger.exception("Error processing update %s", update.update_id)
+            finally:
+                shard.task_done()
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self._worker(shard)) for shard in self.shards]
+
+    async def stop(self, timeout: float = 10):
+        # Даём дообработать то, что уже принято
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self.shards)), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Update queue stopped with %d unprocessed updates", self.qsize())
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
@@ -1,23 +1,90 @@
+import os
+from functools import lru_cache
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from models import RoleEnum
+from models import RoleEnum, Department
+from cache import TTLCache
+from pagination import fetch_page, page_keyboard
+from refdata import refdata
 
+# Статичные меню зависят только от роли - строим один раз и переиспользуем.
+# Разметку после построения не изменяем: один объект отдаётся всем хендлерам.
+
+@lru_cache(maxsize=None)
 def main_menu(role: RoleEnum):
     kb = InlineKeyboardBuilder()
     if role == RoleEnum.admin:
         kb.button(text="👥 Админ меню", callback_data="admin:main_menu")
         kb.button(text="📊 Статистика", callback_data="stats:admin")
+        kb.button(text="🏆 Рейтинг", callback_data="leaderboard")
     elif role == RoleEnum.manager:
         kb.button(text="📋 Задачи отдела", callback_data="tasks:department")
         kb.button(text="📊 Статистика отдела", callback_data="stats:department")
+        kb.button(text="🏆 Рейтинг", callback_data="leaderboard")
     elif role == RoleEnum.employee:
         kb.button(text="➕ Новая задача", callback_data="tasks:new")
         kb.button(text="📝 Мои задачи", callback_data="tasks:my")
         kb.button(text="📊 Моя статистика", callback_data="stats:personal")
+        kb.button(text="🏆 Рейтинг", callback_data="leaderboard")
     kb.adjust(1)
     return kb.as_markup()
 
+@lru_cache(maxsize=None)
 def back_to_main():
     kb = InlineKeyboardBuilder()
     kb.button(text="⬅️ Назад", callback_data="main_menu")
     kb.adjust(1)
     return kb.as_markup()
+
+@lru_cache(maxsize=None)
+def admin_menu():
+    kb = InlineKeyboardBuilder()
+    kb.button(text="👥 Пользователи", callback_data="admin:users")
+    kb.button(text="🏢 Отделы", callback_data="admin:departments")
+    kb.button(text="📊 Статистика", callback_data="admin:stats")
+    kb.button(text="📥 Выгрузка статистики (XLSX)", callback_data="admin:export_stats")
+    kb.adjust(1)
+    return kb.as_markup()
+
+@lru_cache(maxsize=None)
+def admin_stats_keyboard():
+    kb = InlineKeyboardBuilder()
+    kb.button(text="📊 Статистика по отделам", callback_data="stats:admin:departments")
+    kb.button(text="📊 Статистика по пользователям", callback_data="stats:admin:users")
+    kb.button(text="📥 Выгрузить статистику в XLSX", callback_data="stats:admin:export")
+    kb.button(text="📥 XLSX с детализацией по задачам", callback_data="stats:admin:export:xlsx:tasks")
+    kb.button(text="📥 CSV (ZIP) с детализацией по задачам", callback_data="stats:admin:export:csv:tasks")
+    kb.button(text="⬅️ Назад", callback_data="main_menu")
+    kb.adjust(1)
+    return kb.as_markup()
+
+@lru_cache(maxsize=None)
+def leaderboard_keyboard():
+    kb = InlineKeyboardBuilder()
+    kb.button(text="🌍 Общий", callback_data="leaderboard")
+    kb.button(text="🏢 Мой отдел", callback_data="leaderboard:department")
+    kb.button(text="⬅️ Назад", callback_data="main_menu")
+    kb.adjust(2, 1)
+    return kb.as_markup()
+
+# Списки отделов по страницам: (base, direction, key) -> разметка.
+# Сбрасываются при создании/переименовании/удалении отдела; TTL - страховка для других процессов.
+department_keyboards = TTLCache(
+    maxsize=int(os.getenv("KEYBOARD_CACHE_SIZE", 1000)),
+    ttl=float(os.getenv("KEYBOARD_CACHE_TTL", 300)),
+)
+
+async def department_page_keyboard(session, base, item_prefix, direction="n", key=None, extra=(), back=None):
+    """Страница списка отделов: кнопка отдела ведёт на f"{item_prefix}{id}"."""
+    cache_key = (base, direction, key)
+    kb = department_keyboards.get(cache_key)
+    if kb is None:
+        page = await fetch_page(session, Department.id, [Department.name], direction=direction, key=key)
+        kb = page_keyboard(page, lambda d: (d.name, f"{item_prefix}{d.id}"), base, extra=extra, back=back)
+        department_keyboards.set(cache_key, kb)
+    return kb
+
+def invalidate_departments():
+    department_keyboards.clear()
+
+# Сброс справочника отделов (в том числе из другого процесса) сбрасывает и клавиатуры
+refdata.on_invalidate("departments", invalidate_departments)
@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import os
+from collections import namedtuple
+from sqlalchemy import select
+from db import AsyncSessionLocal
+from models import User
+from sortedcontainers import SortedList
+
+logger = logging.getLogger(__name__)
+
+LEADERBOARD_SIZE = int(os.getenv("LEADERBOARD_SIZE", 10))
+# Полная перезагрузка из БД: баллы могли измениться в другом процессе
+LEADERBOARD_RELOAD = float(os.getenv("LEADERBOARD_RELOAD", 300))
+
+Entry = namedtuple("Entry", "username points department_id")
+Place = namedtuple("Place", "rank user_id username points")
+
+def _key(user_id, entry):
+    # Больше баллов - выше; при равенстве - по id
+    return (-entry.points, user_id)
+
+class Leaderboard:
+    """
+    Рейтинг активных пользователей в памяти: общий и по отделам.
+    Место пользователя - число пользователей с большим числом баллов + 1 (поиск O(log n)).
+    """
+
+    def __init__(self):
+        self.users = {}  # user_id -> Entry
+        self.all = SortedList()
+        self.departments = {}  # department_id -> отсортированные ключи
+        self.task = None
+
+    def _index(self, department_id):
+        if department_id is None:
+            return self.all
+        return self.departments.get(department_id)
+
+    def _insert(self, user_id, entry):
+        self.users[user_id] = entry
+        key = _key(user_id, entry)
+        self.all.add(key)
+        if entry.department_id is not None:
+            self.departments.setdefault(entry.department_id, SortedList()).add(key)
+
+    def remove(self, user_id):
+        entry = self.users.pop(user_id, None)
+        if entry is None:
+            return
+        key = _key(user_id, entry)
+        self.all.discard(key)
+        department = self.departments.get(entry.department_id)
+        if department is not None:
+            department.discard(key)
+
+    def upsert(self, user_id, username, points, department_id, is_active=True):
+        """Добавить/обновить пользователя после изменения в админке (неактивные в рейтинг не входят)."""
+        self.remove(user_id)
+        if is_active:
+            self._insert(user_id, Entry(username, points or 0, department_id))
+
+    def drop_department(self, department_id):
+        """Отдел удалён: его сотрудники остаются в общем рейтинге без отдела."""
+        index = self.departments.pop(department_id, None)
+        for _, user_id in index or ():
+            self.users[user_id] = self.users[user_id]._replace(department_id=None)
+
+    def update_points(self, balances: dict):
+        """Новые балансы {user_id: points} после points.apply (вызывать после commit)."""
+        for user_id, points in balances.items():
+            entry = self.users.get(user_id)
+            if entry is not None and entry.points != points:
+                self.remove(user_id)
+                self._insert(user_id, entry._replace(points=points))
+
+    def _rank(self, index, points):
+        return index.bisect_left((-points,)) + 1
+
+    def top(self, n=LEADERBOARD_SIZE, department_id=None) -> list:
+        index = self._index(department_id)
+        if not index:
+            return []
+        places = []
+        for neg_points, user_id in index[:n]:
+            points = -neg_points
+            places.append(Place(self._rank(index, points), user_id, self.users[user_id].username, points))
+        return places
+
+    def rank(self, user_id, department_id=None):
+        """(место, всего) пользователя в общем рейтинге или в рейтинге отдела; None - его там нет."""
+        entry = self.users.get(user_id)
+        if entry is None or (department_id is not None and entry.department_id != department_id):
+            return None
+        index = self._index(department_id)
+        return self._rank(index, entry.points), len(index)
+
+    async def load(self):
+        """Загрузить рейтинг из БД (без ORDER BY - сортируем в памяти)."""
+        async with AsyncSessionLocal() as session:
+            rows = (await session.execute(
+                select(User.id, User.username, User.points, User.department_id).where(User.is_active == True)
+            )).all()
+        users = {row.id: Entry(row.username, row.points or 0, row.department_id) for row in rows}
+        by_department = {}
+        for user_id, entry in users.items():
+            if entry.department_id is not None:
+                by_department.setdefault(entry.department_id, []).append(_key(user_id, entry))
+        self.users = users
+        self.all = SortedList(_key(user_id, entry) for user_id, entry in users.items())
+        self.departments = {dept_id: SortedList(keys) for dept_id, keys in by_department.items()}
+        logger.info("Leaderboard: loaded %d users", len(users))
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(LEADERBOARD_RELOAD)
+            try:
+                await self.load()
+            except Exception:
+                logger.exception("Leaderboard: reload failed")
+
+    async def start(self):
+        await self.load()
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+leaderboard = Leaderboard()
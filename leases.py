@@ -0,0 +1,55 @@
+import functools
+import logging
+import os
+import socket
+from datetime import datetime, timedelta
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+from db import AsyncSessionLocal
+from models import JobLease
+
+logger = logging.getLogger(__name__)
+
+# Идентификатор этого процесса в кластере
+HOLDER = f"{socket.gethostname()}:{os.getpid()}"
+
+# name -> последнее состояние задачи в этом процессе (для health-эндпоинта)
+job_status = {}
+
+EPOCH = datetime(1970, 1, 1)
+
+def current_slot(interval_seconds: float, now: datetime = None) -> datetime:
+    # Начало текущего интервала (UTC): все процессы получают одно и то же значение
+    elapsed = ((now or datetime.utcnow()) - EPOCH).total_seconds()
+    return EPOCH + timedelta(seconds=elapsed - elapsed % interval_seconds)
+
+async def claim(name: str, slot: datetime) -> bool:
+    """Забрать задачу на интервал slot. True - этот процесс выполняет задачу."""
+    now = datetime.utcnow()
+    async with AsyncSessionLocal() as session:
+        stmt = insert(JobLease).values(name=name, holder=HOLDER, slot=slot, acquired_at=now)
+        claimed = (await session.execute(
+            stmt.on_conflict_do_update(
+                index_elements=[JobLease.name],
+                set_={"holder": HOLDER, "slot": slot, "acquired_at": now},
+                where=JobLease.slot < slot,
+            ).returning(JobLease.name)
+        )).first() is not None
+        holder = HOLDER if claimed else (await session.execute(
+            select(JobLease.holder).where(JobLease.name == name)
+        )).scalar()
+        await session.commit()
+    job_status[name] = {"slot": slot.isoformat(), "holder": holder, "leader": claimed}
+    return claimed
+
+def singleton(name: str, interval_seconds: float):
+    """Декоратор: из всех процессов задачу в каждом интервале выполняет только один."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if not await claim(name, current_slot(interval_seconds)):
+                logger.debug("Job %s is handled by another instance", name)
+                return None
+            return await func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,133 @@
+import atexit
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import sys
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+# Общий уровень и уровни отдельных модулей: LOG_LEVELS="aiogram=WARNING,notifications=DEBUG"
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_LEVELS = os.getenv("LOG_LEVELS", "apscheduler=WARNING")
+# json - одна JSON-строка на запись, text - обычный читаемый формат
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+# Частые INFO-события (по записи на каждый апдейт) пишем только для доли апдейтов
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", 0.1))
+LOG_SAMPLED_LOGGERS = tuple(filter(None, os.getenv("LOG_SAMPLED_LOGGERS", "aiogram.event").split(",")))
+
+# Контекст текущего апдейта, добавляется в каждую запись
+update_id_var = contextvars.ContextVar("update_id", default=None)
+user_id_var = contextvars.ContextVar("user_id", default=None)
+
+def bind(update_id=None, user_id=None):
+    """Привязать апдейт к логам текущей задачи. Возвращает токены для unbind."""
+    return update_id_var.set(update_id), user_id_var.set(user_id)
+
+def unbind(tokens):
+    update_id_var.reset(tokens[0])
+    user_id_var.reset(tokens[1])
+
+@contextlib.contextmanager
+def update_context(update):
+    """
+    Контекст апдейта вокруг dp.feed_update: так его получает и запись aiogram.event
+    ("Update id=... is handled"), которую aiogram пишет уже после цепочки middleware.
+    """
+    try:
+        from_user = getattr(update.event, "from_user", None)
+    except Exception:
+        # Неизвестный aiogram тип апдейта
+        from_user = None
+    tokens = bind(update.update_id, from_user.id if from_user else None)
+    try:
+        yield
+    finally:
+        unbind(tokens)
+
+class ContextFilter(logging.Filter):
+    def filter(self, record):
+        record.update_id = update_id_var.get()
+        record.user_id = user_id_var.get()
+        return True
+
+class SamplingFilter(logging.Filter):
+    """
+    Пропускает только долю rate записей уровня INFO и ниже от указанных логгеров.
+    Решение принимается по update_id, поэтому записи одного апдейта попадают в лог вместе.
+    """
+
+    def __init__(self, rate, loggers):
+        super().__init__()
+        self.rate = rate
+        self.loggers = loggers
+
+    def filter(self, record):
+        if self.rate >= 1 or record.levelno > logging.INFO or not record.name.startswith(self.loggers):
+            return True
+        update_id = getattr(record, "update_id", None)
+        if update_id is not None:
+            return update_id % 1000 < self.rate * 1000
+        return random.random() < self.rate
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if getattr(record, "update_id", None) is not None:
+            entry["update_id"] = record.update_id
+        if getattr(record, "user_id", None) is not None:
+            entry["user_id"] = record.user_id
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class _QueueHandler(QueueHandler):
+    def prepare(self, record):
+        # В цикле событий только подставляем аргументы в сообщение (они могут измениться позже);
+        # форматирование и запись - в потоке QueueListener
+        record.msg, record.args = record.getMessage(), None
+        return record
+
+def _parse_levels(spec: str) -> dict:
+    levels = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, level = item.partition("=")
+        levels[name.strip()] = level.strip().upper()
+    return levels
+
+_listener = None
+
+def setup_logging():
+    """Настроить логирование процесса: запись в stdout из отдельного потока через очередь."""
+    global _listener
+    if _listener is not None:
+        return
+    if LOG_FORMAT == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter("%(asctime)s %(levelname)s %(name)s [%(update_id)s:%(user_id)s] %(message)s")
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    handler = _QueueHandler(log_queue)
+    handler.addFilter(ContextFilter())
+    handler.addFilter(SamplingFilter(LOG_SAMPLE_RATE, LOG_SAMPLED_LOGGERS))
+
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(LOG_LEVEL.upper())
+    for name, level in _parse_levels(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level)
+
+    _listener = QueueListener(log_queue, output)
+    _listener.start()
+    atexit.register(_listener.stop)
@@ -1,100 +1,232 @@
 import asyncio
+import hmac
+import multiprocessing
 import os
+import sys
+import time
+from collections import deque
+from multiprocessing.connection import wait
 from aiohttp import web
 from aiogram import Dispatcher
 from aiogram.types import Update
-from models import Base, User, RoleEnum
-from db import engine, AsyncSessionLocal
-from handlers import registration, tasks, admin_panel
-from scheduler import scheduler
+from migrations import migrate
+from db import engine, pool_status
+from middlewares import (
+    DbSessionMiddleware, AuthMiddleware, FSMFlushMiddleware,
+    UpdateMetricsMiddleware, HandlerMetricsMiddleware, TelegramMetricsMiddleware,
+    ThrottlingMiddleware, THROTTLE_ENABLED, ReleaseDbSessionMiddleware,
+)
+from fsm_storage import create_storage, PostgresStorage
+from cache import CachedUser
+from handlers import registration, tasks, admin_panel, leaderboard as leaderboard_handlers
+from scheduler import scheduler, escalate_due
+import leases
 from bot_instance import bot
+from notifications import outbox
+from events import task_events
+from deadlines import deadlines
+from refdata import refdata
+from leaderboard import leaderboard
+from dedup import dedup
+from ingest import UpdateQueue, WEBHOOK_MODE
 from keyboards import main_menu
+import metrics
+from logconfig import setup_logging, update_context
 import logging
 
-# Настройка логирования
-logging.basicConfig(level=logging.DEBUG)
+try:
+    # Быстрый JSON-декодер, если установлен
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+# Настройка логирования: JSON в stdout из отдельного потока, уровни из LOG_LEVEL / LOG_LEVELS
+setup_logging()
 logger = logging.getLogger(__name__)
 
 ADMIN_ID = int(os.getenv("ADMIN_ID"))
 WEBHOOK_PATH = "/webhook/{token}"  # Путь для вебхука с токеном
-WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # Например: https://botwork2.onrender.com/webhook/<your-token>
+# Если задан секрет - Telegram передаёт его в заголовке X-Telegram-Bot-Api-Secret-Token,
+# и токен бота в URL не нужен
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_SECRET_PATH = "/webhook"
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # Например: https://botwork2.onrender.com/webhook/<your-token> (или .../webhook с секретом)
+# Количество веб-процессов на одном порту (SO_REUSEPORT). Вебхук ставит/снимает только процесс 0.
+# Ограничение: ядро раздаёт соединения процессам без учёта чата, поэтому порядок апдейтов
+# одного чата (шарды UpdateQueue) гарантируется только внутри процесса. При WEB_WORKERS > 1
+# два быстрых апдейта одного чата могут обработаться параллельно в разных процессах
+# (например, два шага одного FSM-диалога). Где порядок важен - WEB_WORKERS=1.
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", 1))
+# Упавший воркер перезапускается с нарастающей паузой (1, 2, 4... до 60 с); если он упал
+# WORKER_MAX_RESTARTS раз за WORKER_RESTART_WINDOW секунд (БД недоступна, порт занят) - выходим с ошибкой
+WORKER_MAX_RESTARTS = int(os.getenv("WORKER_MAX_RESTARTS", 5))
+WORKER_RESTART_WINDOW = float(os.getenv("WORKER_RESTART_WINDOW", 300))
+worker_index = 0
 
-dp = Dispatcher()
+storage = create_storage()
+dp = Dispatcher(storage=storage)
+dp.update.outer_middleware(UpdateMetricsMiddleware())
+if isinstance(storage, PostgresStorage):
+    dp.update.outer_middleware(FSMFlushMiddleware(storage))
+dp.update.outer_middleware(DbSessionMiddleware())
+auth_middleware = AuthMiddleware(admin_states=admin_panel.ADMIN_STATES)
+dp.message.outer_middleware(auth_middleware)
+dp.callback_query.outer_middleware(auth_middleware)
+# Частые и повторные нажатия отсекаем до хендлера, но после проверки доступа:
+# посторонние не заводят себе счётчиков
+if THROTTLE_ENABLED:
+    dp.callback_query.outer_middleware(ThrottlingMiddleware())
 
 dp.include_router(registration.router)
 dp.include_router(tasks.router)
 dp.include_router(admin_panel.router)
+dp.include_router(leaderboard_handlers.router)
+for name, router in (("registration", registration.router), ("tasks", tasks.router), ("admin_panel", admin_panel.router),
+                     ("leaderboard", leaderboard_handlers.router)):
+    router.message.middleware(HandlerMetricsMiddleware(name))
+    router.callback_query.middleware(HandlerMetricsMiddleware(name))
+
+metrics.instrument_engine(engine.sync_engine)
+# Снаружи метрик: время commit не попадает во время запроса к Bot API
+bot.session.middleware(ReleaseDbSessionMiddleware())
+bot.session.middleware(TelegramMetricsMiddleware())
+
+update_queue = UpdateQueue(dp, bot) if WEBHOOK_MODE == "queue" else None
 
 @dp.callback_query(lambda c: c.data == "main_menu")
-async def show_main_menu(callback):
-    async with AsyncSessionLocal() as session:
-        user = await session.get(User, callback.from_user.id)
-        if not user or not user.is_active:
-            await callback.answer("Доступ запрещён", show_alert=True)
-            return
-        kb = main_menu(user.role)
-        await callback.message.edit_text("Главное меню:", reply_markup=kb)
+async def show_main_menu(callback, user: CachedUser):
+    if not user or not user.is_active:
+        await callback.answer("Доступ запрещён", show_alert=True)
+        return
+    kb = main_menu(user.role)
+    await callback.message.edit_text("Главное меню:", reply_markup=kb)
 
 async def on_startup():
     logger.info("Starting the bot...")
     try:
-        async with engine.begin() as conn:
-            await conn.run_sync(Base.metadata.create_all)
-        logger.info("Database tables created successfully.")
+        await migrate(engine)
+        logger.info("Database migrations applied successfully.")
+        # Недоставленные сообщения забирает тот процесс, который первым их захватит
+        await outbox.start()
+        logger.info("Notification outbox started.")
+        task_events.start()
+        # Сброс кэша справочников по уведомлениям из других процессов
+        refdata.start()
+        await leaderboard.start()
+        logger.info("Leaderboard loaded.")
+        if update_queue is not None:
+            update_queue.start()
+            logger.info("Update queue started with %d workers.", len(update_queue.shards))
         scheduler.start()
+        await deadlines.start(metrics.track_job("deadline_escalation")(escalate_due))
         logger.info("Scheduler started successfully.")
         
         # Устанавливаем вебхук
-        await bot.set_webhook(WEBHOOK_URL)
-        logger.info(f"Webhook set to {WEBHOOK_URL}")
+        if worker_index == 0:
+            await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+            logger.info("Webhook set to %s", WEBHOOK_URL)
     except Exception as e:
-        logger.error(f"Failed to set webhook: {e}")
+        logger.error("Failed to set webhook: %s", e)
         raise
 
 async def on_shutdown_handler(app):
     logger.info("Shutting down the bot...")
-    # Удаляем webhook и закрываем сессию
-    await bot.delete_webhook()
+    # Удаляем webhook, дообрабатываем очередь и закрываем сессию
+    if worker_index == 0:
+        await bot.delete_webhook()
+    if update_queue is not None:
+        await update_queue.stop()
+    await deadlines.stop()
+    await refdata.stop()
+    await leaderboard.stop()
+    await outbox.stop()
+    await task_events.stop()
+    await storage.close()
     await bot.session.close()
     logger.info("Webhook deleted and bot session closed")
 
-# Проверка здоровья сервера
+# Проверка здоровья сервера: состояние процесса и лидерство по задачам планировщика
 async def handle(request):
-    logger.info("Health check request received.")
-    return web.Response(text="OK")
+    return web.json_response({
+        "status": "ok",
+        "worker": worker_index,
+        "workers": WEB_WORKERS,
+        "instance": leases.HOLDER,
+        "update_queue": update_queue.qsize() if update_queue is not None else None,
+        "jobs": leases.job_status,
+    })
+
+# Состояние пула соединений с БД
+async def handle_db_pool(request):
+    return web.json_response(pool_status())
+
+metrics.Gauge("bot_db_pool_connections", "DB pool connections by state",
+              lambda: {(k,): v for k, v in pool_status().items()}, ["state"])
+metrics.Gauge("bot_update_queue_size", "Updates waiting in the update queue",
+              lambda: {(): update_queue.qsize()} if update_queue is not None else {})
+metrics.Gauge("bot_outbox_pending", "Outgoing messages waiting for delivery",
+              lambda: {(): sum(len(q) for q in outbox.pending.values())})
+metrics.Gauge("bot_task_deadlines", "Task deadlines tracked in memory", lambda: {(): len(deadlines.due)})
+metrics.Gauge("bot_leaderboard_users", "Users in the in-memory leaderboard", lambda: {(): len(leaderboard.users)})
+
+# Метрики процесса в формате Prometheus
+async def handle_metrics(request):
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+def _authorized(request) -> bool:
+    # Сравнение за постоянное время, чтобы секрет нельзя было подобрать по таймингу
+    if WEBHOOK_SECRET:
+        received = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        return hmac.compare_digest(received.encode(), WEBHOOK_SECRET.encode())
+    received = request.match_info.get("token", "")
+    return hmac.compare_digest(received.encode(), bot.token.encode())
 
-# Обработчик вебхуков Telegram
 # Обработчик вебхуков Telegram
 async def handle_webhook(request):
-    logger.info("Webhook request received.")
-    
-    # Логируем полный путь запроса, чтобы увидеть, что передается
-    logger.debug(f"Request path: {request.path}")
-    
-    # Извлекаем токен из пути запроса
-    token_from_request = request.match_info.get('token')
-    logger.debug(f"Received token: {token_from_request}")
-    
-    if token_from_request == bot.token:
-        request_body = await request.text()
-        update = Update.parse_raw(request_body)
-        
+    logger.debug("Webhook request received: %s", request.method)
+
+    if not _authorized(request):
+        logger.warning("Invalid webhook secret received.")
+        return web.Response(status=403, text="Forbidden")
+
+    # Тело читаем один раз байтами и разбираем без промежуточной строки
+    request_body = await request.read()
+    try:
+        update = Update(**json_loads(request_body))
+    except (ValueError, TypeError) as e:
+        logger.warning("Malformed update received: %s", e)
+        return web.Response(status=400, text="Bad Request")
+
+    with update_context(update):
+        # Повторная доставка уже принятого апдейта: подтверждаем, но не обрабатываем
+        if await dedup.seen(update.update_id):
+            return web.Response(status=200)
+
+        if update_queue is not None:
+            # Отвечаем Telegram сразу, обработка - в пуле воркеров
+            if not await update_queue.submit(update):
+                # Очередь переполнена: Telegram повторит доставку позже, и её нужно будет принять
+                await dedup.forget(update.update_id)
+                return web.Response(status=503, text="Service Unavailable")
+            return web.Response(status=200)
+
         try:
-            # Используем process_update для одного обновления
-            await dp.process_update(update)  # Передаем одно обновление, не список
-            logger.info("Received and processed update.")
+            await dp.feed_update(bot, update)
             return web.Response(status=200)
-        except Exception as e:
-            logger.error(f"Error processing update: {e}")
+        except Exception:
+            logger.exception("Error processing update %s", update.update_id)
+            await dedup.forget(update.update_id)
             return web.Response(status=500, text="Internal Server Error")
-    else:
-        logger.warning(f"Invalid token received.")
-        return web.Response(status=403, text="Forbidden")
 
 async def start_web_server():
     app = web.Application()
     app.router.add_get("/", handle)
-    app.router.add_post(WEBHOOK_PATH, handle_webhook)  # Регистрируем путь с токеном в URL
+    app.router.add_get("/health/db", handle_db_pool)
+    app.router.add_get("/metrics", handle_metrics)
+    if WEBHOOK_SECRET:
+        app.router.add_post(WEBHOOK_SECRET_PATH, handle_webhook)  # Проверка по заголовку с секретом
+    else:
+        app.router.add_post(WEBHOOK_PATH, handle_webhook)  # Регистрируем путь с токеном в URL
 
     # Добавляем обработчик on_shutdown ДО runner.setup()
     app.on_shutdown.append(on_shutdown_handler)
@@ -103,20 +235,75 @@ async def start_web_server():
     port = int(os.environ.get("PORT", 10000))  # Убедитесь, что порт соответствует 10000
     runner = web.AppRunner(app)
     await runner.setup()
-    site = web.TCPSite(runner, "0.0.0.0", port)
+    site = web.TCPSite(runner, "0.0.0.0", port, reuse_port=WEB_WORKERS > 1)
     await site.start()
-    logger.info(f"Web server started on port {port}")
+    logger.info("Web server started on port %d", port)
 
     return app
 
-async def main():
-    logger.info("Bot started.")
+async def main(index: int = 0):
+    global worker_index
+    worker_index = index
+    metrics.const_labels["worker"] = str(index)
+    logger.info("Bot started (worker %d/%d).", index + 1, WEB_WORKERS)
     await on_startup()
     await start_web_server()
     # Держим приложение живым
     while True:
         await asyncio.sleep(3600)
 
+def run_worker(index: int):
+    asyncio.run(main(index))
+
+def run_workers():
+    # Родительский процесс только следит за воркерами и перезапускает упавшие
+    ctx = multiprocessing.get_context("spawn")
+    processes = {}
+    restarts = {index: deque() for index in range(WEB_WORKERS)}  # моменты перезапусков в окне
+    scheduled = {}  # index -> когда перезапустить
+
+    def spawn(index):
+        process = ctx.Process(target=run_worker, args=(index,), name=f"web-worker-{index}")
+        process.start()
+        processes[process.sentinel] = (index, process)
+
+    def terminate_all():
+        for _, process in processes.values():
+            process.terminate()
+
+    for index in range(WEB_WORKERS):
+        spawn(index)
+    try:
+        while processes or scheduled:
+            now = time.monotonic()
+            for index, at in list(scheduled.items()):
+                if at <= now:
+                    del scheduled[index]
+                    spawn(index)
+            timeout = max(min(scheduled.values()) - now, 0) if scheduled else None
+            for sentinel in wait(list(processes), timeout):
+                index, process = processes.pop(sentinel)
+                process.join()
+                now = time.monotonic()
+                history = restarts[index]
+                while history and now - history[0] > WORKER_RESTART_WINDOW:
+                    history.popleft()
+                if len(history) >= WORKER_MAX_RESTARTS:
+                    logger.error("Worker %d exited with code %s %d times within %d s, giving up.",
+                                 index, process.exitcode, len(history) + 1, WORKER_RESTART_WINDOW)
+                    terminate_all()
+                    sys.exit(1)
+                history.append(now)
+                delay = min(2 ** (len(history) - 1), 60)
+                logger.warning("Worker %d exited with code %s, restarting in %d s.", index, process.exitcode, delay)
+                scheduled[index] = now + delay
+    except KeyboardInterrupt:
+        terminate_all()
+
 if __name__ == "__main__":
     logger.info("Running main loop.")
-    asyncio.run(main())
+    if WEB_WORKERS > 1:
+        logger.warning("WEB_WORKERS=%d: updates of one chat are ordered only within a worker process", WEB_WORKERS)
+        run_workers()
+    else:
+        asyncio.run(main())
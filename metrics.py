@@ -0,0 +1,157 @@
+import contextvars
+import functools
+import time
+from bisect import bisect_left
+from sqlalchemy import event
+
+# Метрики процесса в текстовом формате Prometheus (отдаются на /metrics).
+# Без внешних зависимостей: счётчики, гистограммы и гаужи, считаемые при выдаче.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Метки, добавляемые ко всем метрикам (например, номер веб-процесса)
+const_labels = {}
+
+_registry = []
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names, values, extra=()) -> str:
+    pairs = list(const_labels.items()) + list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.label_names = name, help, tuple(labels)
+        self.values = {}
+        _registry.append(self)
+
+    def inc(self, *labels, value=1):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield self.name + _labels(self.label_names, labels), value
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name, self.help, self.label_names = name, help, tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}  # labels -> [счётчики по корзинам..., +Inf, sum]
+        _registry.append(self)
+
+    def observe(self, value, *labels):
+        row = self.values.get(labels)
+        if row is None:
+            row = self.values[labels] = [0] * (len(self.buckets) + 2)
+        row[bisect_left(self.buckets, value)] += 1
+        row[-1] += value
+
+    def samples(self):
+        for labels, row in self.values.items():
+            total = 0
+            for bound, count in zip(self.buckets + ("+Inf",), row):
+                total += count
+                yield self.name + "_bucket" + _labels(self.label_names, labels, [("le", bound)]), total
+            yield self.name + "_sum" + _labels(self.label_names, labels), row[-1]
+            yield self.name + "_count" + _labels(self.label_names, labels), total
+
+class Gauge:
+    """collect() -> {кортеж значений меток: значение}, вызывается при каждой выдаче."""
+    kind = "gauge"
+
+    def __init__(self, name, help, collect, labels=()):
+        self.name, self.help, self.label_names = name, help, tuple(labels)
+        self.collect = collect
+        _registry.append(self)
+
+    def samples(self):
+        for labels, value in self.collect().items():
+            yield self.name + _labels(self.label_names, labels), value
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, value in metric.samples():
+            lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+# --- Метрики горячего пути ---
+
+update_seconds = Histogram("bot_update_seconds", "Update processing time", ["event"])
+handler_seconds = Histogram("bot_handler_seconds", "Handler time by router and callback prefix", ["router", "route"])
+handler_errors = Counter("bot_handler_errors_total", "Handler exceptions", ["router", "route"])
+db_queries = Histogram("bot_db_queries_per_update", "DB queries per update", buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34))
+db_query_seconds = Histogram("bot_db_query_seconds", "DB query time")
+job_seconds = Histogram("bot_job_seconds", "Scheduler job run time", ["job"], buckets=DEFAULT_BUCKETS + (30, 60, 300))
+job_rows = Counter("bot_job_rows_total", "Rows affected by scheduler jobs", ["job"])
+job_errors = Counter("bot_job_errors_total", "Scheduler job failures", ["job"])
+telegram_seconds = Histogram("bot_telegram_request_seconds", "Bot API request time", ["method"])
+telegram_errors = Counter("bot_telegram_errors_total", "Bot API errors", ["method", "error"])
+updates_shed = Counter("bot_updates_shed_total", "Updates rejected because the update queue was full")
+callbacks_throttled = Counter("bot_callbacks_throttled_total", "Callback taps rejected by the rate limit", ["route"])
+callbacks_collapsed = Counter("bot_callbacks_collapsed_total", "Repeated taps collapsed into an in-flight run", ["route"])
+updates_received = Counter("bot_updates_received_total", "Updates received by the webhook")
+task_events_dropped = Counter("bot_task_events_dropped_total", "Task events dropped because the write buffer was full")
+updates_duplicate = Counter("bot_updates_duplicate_total", "Redelivered updates acknowledged without processing", ["source"])
+
+# Счётчик запросов к БД текущего апдейта (см. UpdateMetricsMiddleware)
+current_queries = contextvars.ContextVar("current_queries", default=None)
+
+def callback_prefix(data: str) -> str:
+    # "admin:users:n:15" -> "admin:users", "task:my:7" -> "task:my": без id и курсоров
+    parts = []
+    for part in (data or "").split(":")[:2]:
+        if not part or part.isdigit() or part in ("n", "p"):
+            break
+        parts.append(part)
+    return ":".join(parts) or "-"
+
+def instrument_engine(engine):
+    """Время каждого запроса и число запросов на апдейт через события SQLAlchemy."""
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        db_query_seconds.observe(time.perf_counter() - conn.info["query_start"].pop())
+        counter = current_queries.get()
+        if counter is not None:
+            counter[0] += 1
+
+    @event.listens_for(engine, "handle_error")
+    def _error(context):
+        # after_cursor_execute для упавшего запроса не вызывается - иначе отметка осталась бы
+        # на стеке соединения из пула и сдвинула все следующие замеры
+        stack = context.connection.info.get("query_start") if context.connection is not None else None
+        if stack:
+            db_query_seconds.observe(time.perf_counter() - stack.pop())
+
+def track_job(name: str):
+    """Декоратор задачи планировщика: время выполнения и число затронутых строк (если вернула int)."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = await func(*args, **kwargs)
+            except Exception:
+                job_errors.inc(name)
+                raise
+            finally:
+                job_seconds.observe(time.perf_counter() - start, name)
+            if isinstance(result, int):
+                job_rows.inc(name, value=result)
+            return result
+        return wrapper
+    return decorator
@@ -0,0 +1,255 @@
+import asyncio
+import contextvars
+import os
+import time
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.types import CallbackQuery
+from db import AsyncSessionLocal
+from models import User, RoleEnum
+from cache import user_cache, CachedUser
+import metrics
+from ratelimit import TokenBucket
+
+# Сессия текущего апдейта и задача, которая его обрабатывает (см. ReleaseDbSessionMiddleware)
+current_session = contextvars.ContextVar("current_session", default=None)
+
+class DbSessionMiddleware(BaseMiddleware):
+    """
+    Одна сессия БД на апдейт: открывается здесь и передаётся хендлерам как `session`.
+    Соединение берётся из пула при первом запросе и возвращается после commit/close;
+    перед каждым запросом к Bot API транзакцию завершает ReleaseDbSessionMiddleware.
+    """
+
+    async def __call__(self, handler, event, data):
+        async with AsyncSessionLocal() as session:
+            data["session"] = session
+            token = current_session.set((session, asyncio.current_task()))
+            try:
+                return await handler(event, data)
+            finally:
+                current_session.reset(token)
+
+class ReleaseDbSessionMiddleware(BaseRequestMiddleware):
+    """
+    Middleware сессии бота: перед запросом к Bot API завершает транзакцию сессии текущего апдейта,
+    чтобы соединение не простаивало в пуле "idle in transaction" на время сетевого запроса.
+    Хендлеры отвечают пользователю после своих commit, поэтому здесь коммитится только чтение
+    (или уже сброшенная в БД запись). Сессия с несброшенными изменениями не трогается.
+    expire_on_commit=False: загруженные объекты остаются доступны, следующий запрос откроет новую транзакцию.
+    """
+
+    async def __call__(self, make_request, bot, method):
+        current = current_session.get()
+        # Задачи, созданные из хендлера, наследуют контекст - чужую сессию не трогаем
+        if current is not None and current[1] is asyncio.current_task():
+            session = current[0]
+            if session.in_transaction() and not (session.new or session.dirty or session.deleted):
+                await session.commit()
+        return await make_request(bot, method)
+
+class AuthMiddleware(BaseMiddleware):
+    """
+    Подставляет текущего пользователя (`user`, CachedUser или None) из кэша
+    и пускает в админские разделы только активных администраторов.
+    """
+
+    def __init__(self, admin_prefixes=("admin:", "stats:admin"), admin_states=()):
+        self.admin_prefixes = tuple(admin_prefixes)
+        self.admin_states = tuple(admin_states)
+
+    async def _load_user(self, user_id, session):
+        user = user_cache.get(user_id)
+        if user is None:
+            model = await session.get(User, user_id)
+            if model is None:
+                return None
+            user = CachedUser.from_model(model)
+            user_cache.set(user_id, user)
+        return user
+
+    def _is_admin_route(self, event, data):
+        if isinstance(event, CallbackQuery):
+            return (event.data or "").startswith(self.admin_prefixes)
+        raw_state = data.get("raw_state")
+        return bool(raw_state) and raw_state.startswith(self.admin_states)
+
+    async def __call__(self, handler, event, data):
+        from_user = getattr(event, "from_user", None)
+        user = await self._load_user(from_user.id, data["session"]) if from_user else None
+        data["user"] = user
+        if self._is_admin_route(event, data):
+            if not user or not user.is_active or user.role != RoleEnum.admin:
+                if isinstance(event, CallbackQuery):
+                    await event.answer("Доступ запрещён", show_alert=True)
+                else:
+                    await event.answer("Доступ запрещён")
+                return None
+        return await handler(event, data)
+
+class FSMFlushMiddleware(BaseMiddleware):
+    """Записывает изменения FSM этого апдейта одним запросом, до обработки следующего апдейта чата."""
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    async def __call__(self, handler, event, data):
+        try:
+            return await handler(event, data)
+        finally:
+            await self.storage.flush()
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Время обработки апдейта и число запросов к БД за апдейт."""
+
+    async def __call__(self, handler, event, data):
+        counter = [0]
+        token = metrics.current_queries.set(counter)
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            metrics.update_seconds.observe(time.perf_counter() - start, getattr(event, "event_type", "unknown"))
+            metrics.db_queries.observe(counter[0])
+            metrics.current_queries.reset(token)
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Внутренний middleware роутера: время хендлера по роутеру и префиксу callback_data."""
+
+    def __init__(self, router_name: str):
+        self.router_name = router_name
+
+    async def __call__(self, handler, event, data):
+        if isinstance(event, CallbackQuery):
+            route = metrics.callback_prefix(event.data)
+        else:
+            route = data.get("raw_state") or "message"
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            metrics.handler_errors.inc(self.router_name, route)
+            raise
+        finally:
+            metrics.handler_seconds.observe(time.perf_counter() - start, self.router_name, route)
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Время и ошибки запросов к Bot API (middleware сессии бота)."""
+
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        start = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            metrics.telegram_errors.inc(name, type(e).__name__)
+            raise
+        finally:
+            metrics.telegram_seconds.observe(time.perf_counter() - start, name)
+
+def parse_limits(spec: str) -> dict:
+    """"stats:admin:export=0.1/2,*=3/10" -> {префикс: (токенов в секунду, запас)}; * - все остальные."""
+    limits = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        prefix, _, limit = item.rpartition("=")
+        rate, _, burst = limit.partition("/")
+        limits["" if prefix == "*" else prefix] = (float(rate), float(burst or max(float(rate), 1)))
+    return limits
+
+# 0 - без ограничения частоты и склейки нажатий (нагрузочные прогоны bench/run.py)
+THROTTLE_ENABLED = os.getenv("THROTTLE_ENABLED", "1") == "1"
+# Тяжёлые кнопки ограничены сильнее: выгрузка и отчёты строятся секунды
+THROTTLE_LIMITS = parse_limits(os.getenv(
+    "THROTTLE_LIMITS", "stats:admin:export=0.1/2,stats:admin=0.5/3,task:submit=0.5/2,*=3/10"
+))
+# Сколько повторное нажатие ждёт результата первого, прежде чем ответить "уже выполняется"
+THROTTLE_WAIT = float(os.getenv("THROTTLE_WAIT", 5))
+# В режиме очереди апдейты чата идут по одному: повторное нажатие, сделанное пока первое выполнялось,
+# доходит сюда только после его завершения и без окна запустило бы хендлер второй раз.
+# Такие нажатия молча гасим - результат первого уже на экране.
+THROTTLE_COLLAPSE_WINDOW = float(os.getenv("THROTTLE_COLLAPSE_WINDOW", 1))
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Ограничение частоты нажатий по пользователю и префиксу callback_data
+    и склейка одинаковых нажатий: пока кнопка обрабатывается, повторные не запускают хендлер снова.
+    """
+
+    def __init__(self, limits=THROTTLE_LIMITS, wait=THROTTLE_WAIT, collapse_window=THROTTLE_COLLAPSE_WINDOW):
+        # Сначала самые длинные префиксы
+        self.limits = sorted(limits.items(), key=lambda item: len(item[0]), reverse=True)
+        self.wait = wait
+        self.collapse_window = collapse_window
+        self.buckets = {}
+        self.in_flight = {}  # (user_id, data) -> Future с результатом первого нажатия
+        self.finished = {}   # (user_id, data) -> когда закончилось первое нажатие
+
+    def _bucket(self, user_id, data):
+        for prefix, (rate, burst) in self.limits:
+            if data.startswith(prefix):
+                break
+        else:
+            return None
+        key = (user_id, prefix)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) > 10000:
+                self.buckets = {k: b for k, b in self.buckets.items() if not b.idle}
+            bucket = self.buckets[key] = TokenBucket(rate, burst)
+        return bucket
+
+    async def _collapse(self, event, key):
+        first = self.in_flight.get(key)
+        if first is None:
+            # Первое нажатие уже завершилось (см. THROTTLE_COLLAPSE_WINDOW)
+            await event.answer()
+            return None
+        if self.wait:
+            try:
+                result = await asyncio.wait_for(asyncio.shield(first), self.wait)
+                await event.answer()
+                return result
+            except asyncio.TimeoutError:
+                pass
+            except Exception:
+                # Ошибку первого нажатия уже обработали там
+                await event.answer()
+                return None
+        await event.answer("⏳ Уже выполняется, подождите...")
+        return None
+
+    async def __call__(self, handler, event, data):
+        user = data.get("user")
+        # Незарегистрированным и неактивным хендлер всё равно откажет - счётчики на них не заводим
+        if not isinstance(event, CallbackQuery) or not user or not user.is_active:
+            return await handler(event, data)
+        callback_data = event.data or ""
+        key = (event.from_user.id, callback_data)
+        finished_at = self.finished.get(key)
+        if key in self.in_flight or (finished_at and time.monotonic() - finished_at < self.collapse_window):
+            metrics.callbacks_collapsed.inc(metrics.callback_prefix(callback_data))
+            return await self._collapse(event, key)
+
+        bucket = self._bucket(event.from_user.id, callback_data)
+        wait = bucket.try_acquire() if bucket else 0
+        if wait:
+            metrics.callbacks_throttled.inc(metrics.callback_prefix(callback_data))
+            await event.answer(f"Слишком часто, попробуйте через {max(int(wait + 0.999), 1)} с.")
+            return None
+
+        future = self.in_flight[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await handler(event, data)
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            # Исключение получит первый вызов, ожидающие его не ждут
+            future.exception()
+            raise
+        finally:
+            del self.in_flight[key]
+            if len(self.finished) > 10000:
+                now = time.monotonic()
+                self.finished = {k: t for k, t in self.finished.items() if now - t < self.collapse_window}
+            self.finished[key] = time.monotonic()
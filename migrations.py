@@ -0,0 +1,108 @@
+import logging
+from sqlalchemy import text
+from models import Base
+from deadlines import NEW_TASK_DEADLINE, REVIEW_DEADLINE
+
+logger = logging.getLogger(__name__)
+
+# Ключ advisory lock: миграции не выполняются параллельно из нескольких процессов
+MIGRATIONS_LOCK_KEY = 7_202_401
+
+def create_indexes(*names):
+    # Индексы описаны в models.py, здесь только создаём их на существующей схеме
+    def step(conn):
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                if index.name in names:
+                    index.create(conn, checkfirst=True)
+    return step
+
+def add_task_due_at(conn):
+    conn.execute(text("ALTER TABLE tasks ADD COLUMN IF NOT EXISTS due_at TIMESTAMP"))
+    # Сроки для уже существующих задач - по тем же правилам и настройкам, что и в deadlines.py
+    conn.execute(text(
+        "UPDATE tasks SET due_at = CASE"
+        " WHEN status IN ('new', 'in_progress') THEN created_at + make_interval(hours => :new_hours)"
+        " WHEN status = 'submitted' THEN updated_at + make_interval(hours => :review_hours)"
+        " END"
+        " WHERE due_at IS NULL AND status IN ('new', 'in_progress', 'submitted')"
+    ), {
+        "new_hours": int(NEW_TASK_DEADLINE.total_seconds() // 3600),
+        "review_hours": int(REVIEW_DEADLINE.total_seconds() // 3600),
+    })
+    create_indexes("ix_tasks_due_at")(conn)
+
+def add_outbox_claims(conn):
+    conn.execute(text("ALTER TABLE outbox ADD COLUMN IF NOT EXISTS claimed_by VARCHAR"))
+    conn.execute(text("ALTER TABLE outbox ADD COLUMN IF NOT EXISTS claimed_until TIMESTAMP"))
+
+def widen_outbox_chat_id(conn):
+    conn.execute(text("ALTER TABLE outbox ALTER COLUMN chat_id TYPE BIGINT"))
+
+def add_user_penalties(conn):
+    conn.execute(text("ALTER TABLE user_stats ADD COLUMN IF NOT EXISTS penalties INTEGER NOT NULL DEFAULT 0"))
+    # Уже списанное - из журнала баллов, один раз
+    conn.execute(text(
+        "UPDATE user_stats s SET penalties = l.penalties"
+        " FROM (SELECT user_id, -sum(delta) AS penalties FROM points_ledger WHERE delta < 0 GROUP BY user_id) l"
+        " WHERE s.user_id = l.user_id"
+    ))
+
+def drop_indexes(*names):
+    def step(conn):
+        for name in names:
+            conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+    return step
+
+def create_tables(*names):
+    def step(conn):
+        for name in names:
+            Base.metadata.tables[name].create(conn, checkfirst=True)
+    return step
+
+# (версия, описание, шаг). Шаг получает синхронное соединение внутри транзакции.
+# Уже применённые миграции не меняем - только добавляем новые в конец.
+# Шаги должны быть идемпотентны: на новой БД baseline уже создаёт актуальную схему.
+MIGRATIONS = [
+    (1, "baseline schema", lambda conn: Base.metadata.create_all(conn)),
+    (2, "task and user indexes for hot queries", create_indexes(
+        "ix_tasks_assigned_to_status",
+        "ix_tasks_active_created_at",
+        "ix_tasks_status_updated_at",
+        "ix_tasks_department_id",
+        "ix_users_department_role_active",
+    )),
+    (3, "username prefix search index", create_indexes("ix_users_username_lower")),
+    (4, "persistent FSM storage", create_tables("fsm_states")),
+    (5, "scheduler job leases", create_tables("job_leases")),
+    (6, "task event log", create_tables("task_events")),
+    (7, "task escalation deadlines", add_task_due_at),
+    (8, "update deduplication window", create_tables("processed_updates")),
+    (9, "points ledger", create_tables("points_ledger")),
+    (10, "outbox message claims", add_outbox_claims),
+    (11, "bigint outbox chat ids", widen_outbox_chat_id),
+    (12, "penalties rollup", add_user_penalties),
+    # Эскалация идёт по due_at (ix_tasks_due_at), старые индексы только замедляют запись в tasks
+    (13, "drop unused escalation indexes", drop_indexes("ix_tasks_active_created_at", "ix_tasks_status_updated_at")),
+]
+
+async def migrate(engine):
+    """Применить недостающие миграции (вместо Base.metadata.create_all)."""
+    async with engine.begin() as conn:
+        await conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": MIGRATIONS_LOCK_KEY})
+        await conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            " version INTEGER PRIMARY KEY,"
+            " name VARCHAR NOT NULL,"
+            " applied_at TIMESTAMP NOT NULL DEFAULT now())"
+        ))
+        applied = set((await conn.execute(text("SELECT version FROM schema_migrations"))).scalars().all())
+        for version, name, step in MIGRATIONS:
+            if version in applied:
+                continue
+            logger.info("Applying migration %d: %s", version, name)
+            await conn.run_sync(step)
+            await conn.execute(
+                text("INSERT INTO schema_migrations (version, name) VALUES (:version, :name)"),
+                {"version": version, "name": name},
+            )
@@ -1,6 +1,7 @@
 from sqlalchemy.ext.asyncio import AsyncAttrs
 from sqlalchemy.orm import declarative_base, relationship
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, DateTime, Enum
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy import Column, Integer, BigInteger, String, Boolean, ForeignKey, DateTime, Enum, Float, Index, func
 import enum
 from datetime import datetime
 
@@ -32,6 +33,16 @@ class User(Base, AsyncAttrs):
     department = relationship("Department", back_populates="users")
     tasks = relationship("Task", back_populates="assigned_user")
 
+    __table_args__ = (
+        # Поиск руководителя отдела
+        Index("ix_users_department_role_active", "department_id", "role", "is_active"),
+        # Поиск пользователей по началу имени (LIKE 'prefix%')
+        Index(
+            "ix_users_username_lower", func.lower(username).label("username_lower"),
+            postgresql_ops={"username_lower": "text_pattern_ops"},
+        ),
+    )
+
 class Department(Base, AsyncAttrs):
     __tablename__ = "departments"
 
@@ -52,7 +63,112 @@ class Task(Base, AsyncAttrs):
     assigned_to = Column(Integer, ForeignKey("users.id"), nullable=True)
     issued_by = Column(Integer, ForeignKey("users.id"), nullable=True)
     department_id = Column(Integer, ForeignKey("departments.id"), nullable=True)
+    # Срок, после которого задача эскалируется (NULL - задача больше не ждёт эскалации)
+    due_at = Column(DateTime, nullable=True)
 
     assigned_user = relationship("User", foreign_keys=[assigned_to], back_populates="tasks")
     issued_user = relationship("User", foreign_keys=[issued_by])
     department = relationship("Department", back_populates="tasks")
+
+    __table_args__ = (
+        # Мои задачи
+        Index("ix_tasks_assigned_to_status", "assigned_to", "status"),
+        # Статистика по отделам
+        Index("ix_tasks_department_id", "department_id"),
+        # Сроки эскалации: только задачи, которые ещё ждут срока
+        Index("ix_tasks_due_at", "due_at", postgresql_where=due_at.isnot(None)),
+    )
+
+# Предрассчитанная статистика (инкрементально обновляется при смене статуса задач)
+class UserStats(Base, AsyncAttrs):
+    __tablename__ = "user_stats"
+
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    total_tasks = Column(Integer, default=0, nullable=False)
+    finished_tasks = Column(Integer, default=0, nullable=False)
+    finished_seconds = Column(Float, default=0, nullable=False)
+    # Списано штрафами всего (положительное число); подробности - в points_ledger
+    penalties = Column(Integer, default=0, nullable=False, server_default="0")
+
+class DepartmentStats(Base, AsyncAttrs):
+    __tablename__ = "department_stats"
+
+    department_id = Column(Integer, ForeignKey("departments.id", ondelete="CASCADE"), primary_key=True)
+    points = Column(Integer, default=0, nullable=False)
+    total_tasks = Column(Integer, default=0, nullable=False)
+    finished_tasks = Column(Integer, default=0, nullable=False)
+    finished_seconds = Column(Float, default=0, nullable=False)
+
+# Исходящие сообщения бота, ещё не доставленные в Telegram (переживают рестарт)
+class OutboxMessage(Base, AsyncAttrs):
+    __tablename__ = "outbox"
+
+    id = Column(Integer, primary_key=True)
+    # id чатов Telegram не помещаются в int4
+    chat_id = Column(BigInteger, nullable=False)
+    text = Column(String, nullable=False)
+    kind = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    # Процесс, который держит сообщение в памяти, и до какого момента (см. notifications.OUTBOX_LEASE)
+    claimed_by = Column(String, nullable=True)
+    claimed_until = Column(DateTime, nullable=True)
+
+# Состояния FSM (многошаговые диалоги) - переживают рестарт и общие для всех процессов
+class FSMState(Base, AsyncAttrs):
+    __tablename__ = "fsm_states"
+
+    key = Column(String, primary_key=True)
+    state = Column(String, nullable=True)
+    data = Column(JSONB, nullable=False, default=dict)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+# Аренда периодических задач планировщика: в каждом интервале задачу выполняет ровно один процесс
+class JobLease(Base, AsyncAttrs):
+    __tablename__ = "job_leases"
+
+    name = Column(String, primary_key=True)
+    holder = Column(String, nullable=False)
+    slot = Column(DateTime, nullable=False)
+    acquired_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+# Журнал переходов задач (только добавление, пишется пачками через events.TaskEventWriter)
+class TaskEvent(Base, AsyncAttrs):
+    __tablename__ = "task_events"
+
+    id = Column(BigInteger, primary_key=True)
+    task_id = Column(Integer, ForeignKey("tasks.id", ondelete="CASCADE"), nullable=False)
+    from_status = Column(Enum(TaskStatusEnum), nullable=True)
+    to_status = Column(Enum(TaskStatusEnum), nullable=False)
+    user_id = Column(Integer, nullable=True)
+    at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        # События одной задачи по статусу и времени
+        Index("ix_task_events_task_status_at", "task_id", "to_status", "at"),
+        # Выборки за период
+        Index("ix_task_events_at", "at"),
+    )
+
+# Уже принятые апдейты Telegram (общее окно дедупликации для нескольких реплик, см. dedup.py)
+class ProcessedUpdate(Base, AsyncAttrs):
+    __tablename__ = "processed_updates"
+
+    update_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    received_at = Column(DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+# Журнал изменений баллов (только добавление): каждое начисление/списание и баланс после него
+class PointsLedger(Base, AsyncAttrs):
+    __tablename__ = "points_ledger"
+
+    id = Column(BigInteger, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    delta = Column(Integer, nullable=False)
+    balance_after = Column(Integer, nullable=False)
+    reason = Column(String, nullable=False)
+    task_id = Column(Integer, ForeignKey("tasks.id", ondelete="SET NULL"), nullable=True)
+    at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        # История и итоги по пользователю
+        Index("ix_points_ledger_user_id_at", "user_id", "at"),
+    )
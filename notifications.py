@@ -0,0 +1,281 @@
+import asyncio
+import logging
+import os
+from collections import deque, namedtuple
+from datetime import datetime, timedelta
+from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError, TelegramServerError, TelegramAPIError
+from sqlalchemy import select, insert, update, delete, or_
+from bot_instance import bot
+from db import AsyncSessionLocal
+from models import OutboxMessage
+from leases import HOLDER
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Лимиты Telegram: ~30 сообщений в секунду всего и ~1 в секунду в один чат
+GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", 25))
+CHAT_RATE = float(os.getenv("OUTBOX_CHAT_RATE", 1))
+WORKERS = int(os.getenv("OUTBOX_WORKERS", 4))
+MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 5))
+# Сколько ждём, чтобы склеить несколько эскалаций одному руководителю в один дайджест
+DIGEST_WINDOW = float(os.getenv("OUTBOX_DIGEST_WINDOW", 3))
+MAX_TEXT = 4096
+# Сообщение в БД закреплено за процессом, который его отправляет, пока тот продлевает аренду.
+# Сообщения упавшего процесса подхватывает любой другой (или он сам после рестарта), когда аренда истечёт.
+OUTBOX_LEASE = timedelta(seconds=float(os.getenv("OUTBOX_LEASE", 60)))
+OUTBOX_CLAIM_BATCH = int(os.getenv("OUTBOX_CLAIM_BATCH", 500))
+
+Outgoing = namedtuple("Outgoing", "id chat_id text kind")
+
+def _escalation_text(lines):
+    if len(lines) == 1:
+        return (
+            f"⚠️ Задача {lines[0]} эскалирована к вам.\n"
+            "Пожалуйста, проверьте и примите или отклоните."
+        )
+    return (
+        f"⚠️ К вам эскалировано задач: {len(lines)}\n" + "\n".join(lines) +
+        "\nПожалуйста, проверьте и примите или отклоните."
+    )
+
+# kind -> функция, собирающая текст из одного или нескольких сообщений
+DIGESTS = {
+    "escalation": _escalation_text,
+}
+
+class Outbox:
+    """
+    Очередь исходящих сообщений: глобальный и per-chat rate limit,
+    повторы при 429/сетевых ошибках, дайджесты и хранение в БД до доставки.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.global_bucket = TokenBucket(GLOBAL_RATE)
+        self.chat_buckets = {}
+        self.pending = {}  # chat_id -> deque[Outgoing]
+        self.ready = asyncio.Queue()
+        self.scheduled = set()  # чаты, которые уже стоят в ready (или ждут окна дайджеста)
+        self.sent_ids = []
+        self.held = set()  # id сообщений, которые этот процесс держит в памяти и продлевает
+        self.workers = []
+
+    # --- Публичный API ---
+
+    async def send(self, chat_id: int, text: str, kind: str = None):
+        await self.send_many([(chat_id, text, kind)])
+
+    async def send_many(self, items):
+        """items: [(chat_id, text, kind)]. Сначала сохраняем в БД, потом ставим в очередь."""
+        items = list(items)
+        if not items:
+            return
+        claimed_until = datetime.utcnow() + OUTBOX_LEASE
+        async with AsyncSessionLocal() as session:
+            # Порядок строк в RETURNING не гарантирован - просим вернуть id в порядке items
+            ids = (await session.execute(
+                insert(OutboxMessage).returning(OutboxMessage.id, sort_by_parameter_order=True),
+                [
+                    {"chat_id": c, "text": t, "kind": k, "claimed_by": HOLDER, "claimed_until": claimed_until}
+                    for c, t, k in items
+                ],
+            )).scalars().all()
+            await session.commit()
+        for id_, (chat_id, text, kind) in zip(ids, items):
+            self._enqueue(Outgoing(id_, chat_id, text, kind))
+
+    async def start(self):
+        # Поднимаем недоставленные сообщения, которые больше никто не держит
+        await self._claim_orphans()
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(WORKERS)]
+        self.workers.append(asyncio.create_task(self._flusher()))
+        self.workers.append(asyncio.create_task(self._keep_leases()))
+
+    async def stop(self):
+        for task in self.workers:
+            task.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        await self._flush_sent()
+        await self._release()
+
+    # --- Внутреннее ---
+
+    def _enqueue(self, message):
+        self.held.add(message.id)
+        queue = self.pending.setdefault(message.chat_id, deque())
+        queue.append(message)
+        self._schedule(message.chat_id, DIGEST_WINDOW if message.kind in DIGESTS else 0)
+
+    def _schedule(self, chat_id, delay=0):
+        if chat_id in self.scheduled:
+            return
+        self.scheduled.add(chat_id)
+        if delay:
+            asyncio.get_running_loop().call_later(delay, self.ready.put_nowait, chat_id)
+        else:
+            self.ready.put_nowait(chat_id)
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > 10000:
+                self.chat_buckets = {k: b for k, b in self.chat_buckets.items() if not b.idle}
+            bucket = self.chat_buckets[chat_id] = TokenBucket(CHAT_RATE)
+        return bucket
+
+    def _take_batch(self, chat_id):
+        # Подряд идущие сообщения одного "дайджестного" вида склеиваем в одно
+        queue = self.pending[chat_id]
+        batch = [queue.popleft()]
+        if batch[0].kind in DIGESTS:
+            while queue and queue[0].kind == batch[0].kind:
+                candidate = batch + [queue[0]]
+                if len(DIGESTS[batch[0].kind]([m.text for m in candidate])) > MAX_TEXT:
+                    break
+                batch.append(queue.popleft())
+        return batch
+
+    def _render(self, batch):
+        if batch[0].kind in DIGESTS:
+            return DIGESTS[batch[0].kind]([m.text for m in batch])
+        return batch[0].text
+
+    async def _worker(self):
+        while True:
+            chat_id = await self.ready.get()
+            batch = self._take_batch(chat_id)
+            try:
+                await self._deliver(chat_id, batch)
+            except asyncio.CancelledError:
+                self.pending[chat_id].extendleft(reversed(batch))
+                raise
+            except Exception:
+                logger.exception("Outbox: unexpected error while sending to %s", chat_id)
+            self.scheduled.discard(chat_id)
+            if self.pending.get(chat_id):
+                self._schedule(chat_id)
+            else:
+                self.pending.pop(chat_id, None)
+
+    async def _deliver(self, chat_id, batch):
+        """Отправить пачку с повторами. Доставленные (или безнадёжные) сообщения удаляются из БД."""
+        text = self._render(batch)
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            await self._chat_bucket(chat_id).acquire()
+            await self.global_bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id, text)
+            except TelegramRetryAfter as e:
+                logger.warning("Outbox: flood limit, retry after %s s", e.retry_after)
+                self.global_bucket.pause(e.retry_after)
+                self._chat_bucket(chat_id).pause(e.retry_after)
+                continue
+            except (TelegramNetworkError, TelegramServerError) as e:
+                delay = min(2 ** attempt, 60)
+                logger.warning("Outbox: send to %s failed (%s), attempt %d, retry in %d s", chat_id, e, attempt, delay)
+                await asyncio.sleep(delay)
+                continue
+            except TelegramAPIError as e:
+                # Бот заблокирован, чат не найден и т.п. - повтор не поможет
+                logger.error("Outbox: dropping message to %s: %s", chat_id, e)
+                break
+            else:
+                break
+        else:
+            # Оставляем в БД и перестаём продлевать аренду - сообщение подхватят заново, когда она истечёт
+            logger.error("Outbox: giving up on message to %s after %d attempts", chat_id, MAX_ATTEMPTS)
+            self.held.difference_update(m.id for m in batch)
+            return
+        self.sent_ids.extend(m.id for m in batch)
+        self.held.difference_update(m.id for m in batch)
+
+    async def _flusher(self):
+        while True:
+            await asyncio.sleep(1)
+            try:
+                await self._flush_sent()
+            except Exception:
+                logger.exception("Outbox: failed to delete delivered messages")
+
+    async def _claim_orphans(self):
+        """Забрать сообщения с истёкшей арендой (их процесс упал или сдался). SKIP LOCKED - без гонок между процессами."""
+        while True:
+            now = datetime.utcnow()
+            orphans = (
+                select(OutboxMessage.id)
+                .where(or_(OutboxMessage.claimed_until.is_(None), OutboxMessage.claimed_until < now))
+                .order_by(OutboxMessage.id)
+                .limit(OUTBOX_CLAIM_BATCH)
+                .with_for_update(skip_locked=True)
+                .scalar_subquery()
+            )
+            async with AsyncSessionLocal() as session:
+                rows = (await session.execute(
+                    update(OutboxMessage)
+                    .where(OutboxMessage.id.in_(orphans))
+                    .values(claimed_by=HOLDER, claimed_until=now + OUTBOX_LEASE)
+                    .returning(OutboxMessage.id, OutboxMessage.chat_id, OutboxMessage.text, OutboxMessage.kind)
+                )).all()
+                await session.commit()
+            # RETURNING не упорядочен - восстанавливаем порядок отправки
+            for row in sorted(rows, key=lambda r: r.id):
+                # Своё же сообщение, аренду которого не успели продлить, уже стоит в очереди
+                if row.id not in self.held:
+                    self._enqueue(Outgoing(row.id, row.chat_id, row.text, row.kind))
+            if rows:
+                logger.info("Outbox: claimed %d pending messages", len(rows))
+            if len(rows) < OUTBOX_CLAIM_BATCH:
+                return
+
+    async def _renew(self):
+        if not self.held:
+            return
+        async with AsyncSessionLocal() as session:
+            await session.execute(
+                update(OutboxMessage)
+                .where(OutboxMessage.claimed_by == HOLDER, OutboxMessage.id.in_(list(self.held)))
+                .values(claimed_until=datetime.utcnow() + OUTBOX_LEASE)
+            )
+            await session.commit()
+
+    async def _keep_leases(self):
+        while True:
+            await asyncio.sleep(OUTBOX_LEASE.total_seconds() / 3)
+            try:
+                await self._renew()
+                await self._claim_orphans()
+            except Exception:
+                logger.exception("Outbox: failed to renew or claim messages")
+
+    async def _release(self):
+        # При остановке отдаём неотправленное другим процессам сразу, не дожидаясь конца аренды
+        if not self.held:
+            return
+        ids, self.held = list(self.held), set()
+        try:
+            async with AsyncSessionLocal() as session:
+                await session.execute(
+                    update(OutboxMessage)
+                    .where(OutboxMessage.claimed_by == HOLDER, OutboxMessage.id.in_(ids))
+                    .values(claimed_by=None, claimed_until=None)
+                )
+                await session.commit()
+        except Exception:
+            logger.exception("Outbox: failed to release pending messages")
+
+    async def _flush_sent(self):
+        # Удаляем доставленные сообщения пачкой, а не по одному
+        if not self.sent_ids:
+            return
+        ids, self.sent_ids = self.sent_ids, []
+        try:
+            async with AsyncSessionLocal() as session:
+                await session.execute(delete(OutboxMessage).where(OutboxMessage.id.in_(ids)))
+                await session.commit()
+        except Exception:
+            self.sent_ids.extend(ids)
+            raise
+
+outbox = Outbox(bot)
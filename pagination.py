@@ -0,0 +1,83 @@
+import os
+from aiogram.types import InlineKeyboardButton
+from aiogram.utils.keyboard import InlineKeyboardBuilder
+from sqlalchemy import select
+
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", 20))
+
+# Курсор в callback_data: "<base>:<n|p>:<id>[:<arg>]"
+#   n:<id> - следующая страница (id > <id>), p:<id> - предыдущая (id < <id>),
+#   arg - необязательный фильтр (например, префикс для поиска).
+# Telegram ограничивает callback_data 64 байтами (не символами), поэтому arg обрезаем по байтам UTF-8:
+# "admin:users:n:<id до 19 цифр>:" + 30 байт укладываются в лимит.
+CALLBACK_DATA_BYTES = 64
+MAX_ARG_BYTES = 30
+
+def truncate_bytes(text: str, limit: int) -> str:
+    """Обрезать строку до limit байт UTF-8, не разрывая символ."""
+    return text.encode()[:max(limit, 0)].decode(errors="ignore")
+
+def page_callback(base: str, direction: str = "n", key=None, arg: str = "") -> str:
+    data = f"{base}:{direction}:{'' if key is None else key}"
+    if arg:
+        budget = CALLBACK_DATA_BYTES - len(data.encode()) - 1
+        data += f":{truncate_bytes(arg, min(MAX_ARG_BYTES, budget))}"
+    return data
+
+def parse_page(data: str, base: str):
+    """Разобрать callback_data страницы -> (direction, key, arg). Первая страница - ("n", None, "")."""
+    if data == base:
+        return "n", None, ""
+    parts = data[len(base) + 1:].split(":", 2)
+    direction = parts[0] if parts[0] in ("n", "p") else "n"
+    key = int(parts[1]) if len(parts) > 1 and parts[1] else None
+    arg = parts[2] if len(parts) > 2 else ""
+    return direction, key, arg
+
+class Page:
+    def __init__(self, rows, has_prev, has_next):
+        self.rows = rows
+        self.has_prev = has_prev
+        self.has_next = has_next
+
+async def fetch_page(session, id_column, columns, filters=(), direction="n", key=None, limit=PAGE_SIZE):
+    """
+    Keyset-пагинация: выбираем только нужные узкие колонки и не больше limit+1 строк,
+    без OFFSET - стоимость страницы не зависит от её номера.
+    """
+    q = select(id_column, *columns).where(*filters)
+    if direction == "p" and key is not None:
+        q = q.where(id_column < key).order_by(id_column.desc())
+    else:
+        if key is not None:
+            q = q.where(id_column > key)
+        q = q.order_by(id_column)
+    rows = (await session.execute(q.limit(limit + 1))).all()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if direction == "p" and key is not None:
+        return Page(list(reversed(rows)), has_prev=more, has_next=True)
+    return Page(rows, has_prev=key is not None, has_next=more)
+
+def page_keyboard(page, item, base, arg="", extra=(), back=None):
+    """
+    item(row) -> (text, callback_data) для строки страницы.
+    extra - дополнительные кнопки (text, callback_data) под списком, back - callback_data кнопки "Назад".
+    """
+    kb = InlineKeyboardBuilder()
+    for row in page.rows:
+        text, callback_data = item(row)
+        kb.button(text=text, callback_data=callback_data)
+    kb.adjust(1)
+    nav = []
+    if page.has_prev and page.rows:
+        nav.append(InlineKeyboardButton(text="◀️", callback_data=page_callback(base, "p", page.rows[0][0], arg)))
+    if page.has_next and page.rows:
+        nav.append(InlineKeyboardButton(text="▶️", callback_data=page_callback(base, "n", page.rows[-1][0], arg)))
+    if nav:
+        kb.row(*nav)
+    for text, callback_data in extra:
+        kb.row(InlineKeyboardButton(text=text, callback_data=callback_data))
+    if back:
+        kb.row(InlineKeyboardButton(text="⬅️ Назад", callback_data=back))
+    return kb.as_markup()
@@ -0,0 +1,91 @@
+from collections import defaultdict, namedtuple
+from datetime import datetime
+from sqlalchemy import select, update, insert, func, case
+from models import User, PointsLedger
+import stats
+
+# Одно изменение баллов: кому, на сколько, почему и по какой задаче
+PointsChange = namedtuple("PointsChange", "user_id delta reason task_id")
+
+ESCALATION = "escalation"
+
+def _compose(deltas):
+    """
+    Последовательность изменений x -> max(x + d, 0) сводится к x -> max(x + shift, floor),
+    поэтому любое число изменений одного пользователя применяется одним выражением.
+    """
+    shift, floor = 0, 0
+    for d in deltas:
+        shift += d
+        floor = max(floor + d, 0)
+    return shift, floor
+
+async def apply(session, changes, stats_delta=None) -> dict:
+    """
+    Применить изменения баллов одним UPDATE (баллы не уходят ниже нуля) и записать их в points_ledger.
+    Изменения одного пользователя применяются по порядку. Возвращает {user_id: новый баланс}.
+    Баллы отделов и счётчик штрафов попадают в stats_delta; если его не передали - применяются здесь.
+    Коммит - на вызывающем.
+    """
+    by_user = defaultdict(list)
+    for change in changes:
+        if change.user_id and change.delta:
+            by_user[change.user_id].append(change)
+    if not by_user:
+        return {}
+    composed = {user_id: _compose(c.delta for c in items) for user_id, items in by_user.items()}
+    shifts = {user_id: shift for user_id, (shift, _) in composed.items()}
+    floors = {user_id: floor for user_id, (_, floor) in composed.items()}
+
+    old = (
+        select(User.id, User.points.label("old_points"))
+        .where(User.id.in_(list(by_user)))
+        .with_for_update()
+        .subquery()
+    )
+    rows = (await session.execute(
+        update(User)
+        .where(User.id == old.c.id)
+        .values(points=func.greatest(
+            User.points + case(shifts, value=User.id, else_=0),
+            case(floors, value=User.id, else_=0),
+        ))
+        .returning(User.id, User.department_id, User.points, old.c.old_points)
+        .execution_options(synchronize_session=False)
+    )).all()
+
+    delta = stats_delta if stats_delta is not None else stats.StatsDelta()
+    now = datetime.utcnow()
+    ledger = []
+    for row in rows:
+        balance = row.old_points
+        for change in by_user[row.id]:
+            new_balance = max(balance + change.delta, 0)
+            if new_balance != balance:
+                ledger.append({
+                    "user_id": row.id, "delta": new_balance - balance, "balance_after": new_balance,
+                    "reason": change.reason, "task_id": change.task_id, "at": now,
+                })
+            if new_balance < balance:
+                delta.add_penalty(row.id, balance - new_balance)
+            balance = new_balance
+        delta.add_points(row.department_id, row.points - row.old_points)
+    if ledger:
+        await session.execute(insert(PointsLedger), ledger)
+    if stats_delta is None:
+        await delta.apply(session)
+    return {row.id: row.points for row in rows}
+
+def ledger_totals(user_ids=None):
+    """
+    Подзапрос по журналу: user_id, earned (начислено), penalties (списано, положительное число).
+    Полный проход по журналу - только для сверки (stats.reconcile); экраны читают user_stats.penalties.
+    """
+    q = select(
+        PointsLedger.user_id,
+        func.coalesce(func.sum(PointsLedger.delta).filter(PointsLedger.delta > 0), 0).label("earned"),
+        func.coalesce(-func.sum(PointsLedger.delta).filter(PointsLedger.delta < 0), 0).label("penalties"),
+    ).group_by(PointsLedger.user_id)
+    if user_ids is not None:
+        q = q.where(PointsLedger.user_id.in_(user_ids))
+    return q.subquery()
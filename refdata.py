@@ -0,0 +1,150 @@
+import asyncio
+import logging
+import os
+import time
+from collections import defaultdict
+import asyncpg
+from sqlalchemy import select, func, text
+from sqlalchemy.engine import make_url
+from db import engine, DATABASE_URL
+from models import Department, User, RoleEnum
+from leases import HOLDER
+from cache import user_cache
+
+logger = logging.getLogger(__name__)
+
+# Справочники меняются только из админки, поэтому держим их в памяти процесса.
+# TTL - страховка на случай потерянного уведомления от другого процесса.
+REFDATA_TTL = float(os.getenv("REFDATA_TTL", 600))
+# Сбрасывать кэш во всех процессах через PostgreSQL LISTEN/NOTIFY
+REFDATA_LISTEN = os.getenv("REFDATA_LISTEN", "1") == "1"
+CHANNEL = "refdata"
+KINDS = ("departments", "managers")
+
+async def _load_departments(session) -> dict:
+    rows = (await session.execute(select(Department.id, Department.name).order_by(Department.id))).all()
+    return dict(rows)
+
+async def _load_managers(session) -> dict:
+    # Отдел -> активный руководитель
+    rows = (await session.execute(
+        select(User.department_id, func.min(User.id)).where(
+            User.department_id.isnot(None),
+            User.role == RoleEnum.manager,
+            User.is_active == True
+        ).group_by(User.department_id)
+    )).all()
+    return dict(rows)
+
+LOADERS = {"departments": _load_departments, "managers": _load_managers}
+
+def _dsn() -> str:
+    # asyncpg.connect понимает только обычный postgresql:// URL
+    return make_url(DATABASE_URL).set(drivername="postgresql").render_as_string(hide_password=False)
+
+class RefData:
+    """
+    Кэш справочников: отделы {id: name} и руководители {department_id: user_id}.
+    После изменения в админке вызывается changed(): кэш сбрасывается здесь и в остальных процессах.
+    Тем же каналом рассылается сброс записей кэша пользователей (user_changed).
+    """
+
+    def __init__(self, ttl=REFDATA_TTL):
+        self.ttl = ttl
+        self.values = {}  # kind -> (expires_at, value)
+        self.versions = defaultdict(int)
+        self.hooks = defaultdict(list)
+        self.task = None
+
+    def on_invalidate(self, kind: str, hook):
+        """hook() вызывается при каждом сбросе kind (например, чтобы сбросить зависящие клавиатуры)."""
+        self.hooks[kind].append(hook)
+
+    async def _get(self, kind, session):
+        item = self.values.get(kind)
+        if item is not None and item[0] > time.monotonic():
+            return item[1]
+        version = self.versions[kind]
+        value = await LOADERS[kind](session)
+        # Если во время загрузки пришёл сброс - значение могло устареть, не кэшируем его
+        if self.versions[kind] == version:
+            self.values[kind] = (time.monotonic() + self.ttl, value)
+        return value
+
+    async def departments(self, session) -> dict:
+        return await self._get("departments", session)
+
+    async def managers(self, session) -> dict:
+        return await self._get("managers", session)
+
+    def invalidate(self, *kinds):
+        for kind in kinds or KINDS:
+            self.versions[kind] += 1
+            self.values.pop(kind, None)
+            for hook in self.hooks[kind]:
+                hook()
+
+    async def changed(self, *kinds):
+        """Справочник изменён (вызывать после commit)."""
+        self.invalidate(*kinds)
+        await self._notify(kinds or KINDS)
+
+    async def user_changed(self, *user_ids):
+        """Пользователи изменены в админке (вызывать после commit): сбросить их в кэше пользователей всех процессов."""
+        for user_id in user_ids:
+            user_cache.invalidate(user_id)
+        if user_ids:
+            await self._notify([f"user:{user_id}" for user_id in user_ids])
+
+    async def _notify(self, kinds):
+        if not REFDATA_LISTEN:
+            return
+        try:
+            async with engine.connect() as conn:
+                for kind in kinds:
+                    await conn.execute(text("SELECT pg_notify(:channel, :payload)"),
+                                       {"channel": CHANNEL, "payload": f"{kind}|{HOLDER}"})
+                await conn.commit()
+        except Exception:
+            logger.exception("Refdata: failed to notify other instances")
+
+    def _on_notify(self, connection, pid, channel, payload):
+        kind, _, holder = payload.partition("|")
+        if holder == HOLDER:
+            return
+        if kind.startswith("user:"):
+            user_cache.invalidate(int(kind[len("user:"):]))
+        elif kind in KINDS:
+            self.invalidate(kind)
+
+    async def _listen(self):
+        while True:
+            try:
+                conn = await asyncpg.connect(_dsn())
+            except Exception:
+                logger.exception("Refdata: LISTEN connection failed, retrying")
+                await asyncio.sleep(5)
+                continue
+            closed = asyncio.Event()
+            conn.add_termination_listener(lambda _: closed.set())
+            try:
+                await conn.add_listener(CHANNEL, self._on_notify)
+                # Пока соединения не было, уведомления могли потеряться
+                self.invalidate()
+                user_cache.clear()
+                await closed.wait()
+                logger.warning("Refdata: LISTEN connection lost, reconnecting")
+            finally:
+                await conn.close()
+
+    def start(self):
+        if REFDATA_LISTEN:
+            self.task = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+refdata = RefData()
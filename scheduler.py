@@ -1,79 +1,158 @@
+import os
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from db import AsyncSessionLocal
-from models import Task, TaskStatusEnum, User, RoleEnum
-from sqlalchemy import select
+from models import Task, TaskStatusEnum
+from sqlalchemy import select, update, case, literal
 from datetime import datetime, timedelta
-from bot_instance import bot
+from notifications import outbox
+from events import task_events
+import stats
+import points
+import leases
+import metrics
+from refdata import refdata
+from leaderboard import leaderboard
+from fsm_storage import delete_expired_states
+from dedup import DEDUP_DB, delete_old_updates
 
 scheduler = AsyncIOScheduler()
 
-async def adjust_points(user: User, delta: int, session):
-    user.points = max(user.points + delta, 0)
-    session.add(user)
+# Основная эскалация - по срокам в deadlines.py, это только редкий страховочный проход
+ESCALATION_SWEEP_MINUTES = int(os.getenv("ESCALATION_SWEEP_MINUTES", 15))
+# Штраф исполнителю за эскалированную задачу
+ESCALATION_PENALTY = 10
 
-async def send_manager_notification(manager_id: int, task: Task):
-    text = (
-        f"⚠️ Задача #{task.id} '{task.title}' эскалирована к вам.\n"
-        "Пожалуйста, проверьте и примите или отклоните."
-    )
-    try:
-        await bot.send_message(manager_id, text)
-    except Exception:
-        pass
+def cluster_job(**interval):
+    """
+    Периодическая задача, которая в каждом интервале выполняется ровно одним процессом
+    (остальные реплики пропускают её, см. leases.py).
+    """
+    trigger_kwargs = {k: interval.pop(k) for k in ("next_run_time",) if k in interval}
+    seconds = timedelta(**interval).total_seconds()
 
-@scheduler.scheduled_job("interval", minutes=60)
-async def check_tasks_escalation():
+    def decorator(func):
+        scheduler.add_job(
+            leases.singleton(func.__name__, seconds)(metrics.track_job(func.__name__)(func)), "interval",
+            id=func.__name__, **interval, **trigger_kwargs
+        )
+        return func
+    return decorator
+
+def _status(value: TaskStatusEnum):
+    return literal(value, Task.status.type)
+
+async def escalate_due():
+    """
+    Эскалировать задачи с истёкшим сроком (due_at <= now).
+    Вызывается из deadlines.py к сроку ближайшей задачи и страховочно по расписанию;
+    повторный или параллельный вызов безопасен - обработанные задачи теряют due_at.
+    Возвращает число эскалированных задач.
+    """
+    notifications = []
+    transitions = []
     async with AsyncSessionLocal() as session:
         now = datetime.utcnow()
+        delta = stats.StatsDelta()
+        penalties = []
+        managers = await refdata.managers(session)
 
-        # 1) Старше 24ч - overdue + -10 баллов + эскалация
-        tasks_to_overdue = (await session.execute(
-            select(Task).where(
+        # 1) Истёк срок новой задачи (24ч) - overdue + -10 баллов + эскалация на руководителя отдела
+        old = (
+            select(Task.id, Task.assigned_to.label("old_assigned_to"), Task.status.label("old_status"))
+            .where(
                 Task.status.in_([TaskStatusEnum.new, TaskStatusEnum.in_progress]),
-                Task.created_at <= now - timedelta(hours=24)
+                Task.due_at <= now
+            )
+            .with_for_update(skip_locked=True)
+            .subquery()
+        )
+        if managers:
+            new_status = case(
+                (Task.department_id.in_(list(managers)), _status(TaskStatusEnum.escalated)),
+                else_=_status(TaskStatusEnum.overdue)
+            )
+            new_assignee = case(managers, value=Task.department_id, else_=Task.assigned_to)
+        else:
+            new_status, new_assignee = _status(TaskStatusEnum.overdue), Task.assigned_to
+        rows = (await session.execute(
+            update(Task)
+            .where(Task.id == old.c.id)
+            .values(status=new_status, assigned_to=new_assignee, due_at=None)
+            .returning(
+                Task.id, Task.title, Task.status, Task.assigned_to, Task.department_id,
+                Task.created_at, Task.updated_at, old.c.old_assigned_to, old.c.old_status
+            )
+            .execution_options(synchronize_session=False)
+        )).all()
+        started = await stats.started_at(session, [row.id for row in rows])
+        for row in rows:
+            if row.old_assigned_to:
+                penalties.append(points.PointsChange(row.old_assigned_to, -ESCALATION_PENALTY, points.ESCALATION, row.id))
+            if row.status == TaskStatusEnum.escalated:
+                notifications.append((row.assigned_to, row))
+            transitions.append((row.id, row.old_status, row.status))
+            delta.change(
+                stats.contribution(row.old_status, row.old_assigned_to, row.department_id, row.created_at, row.updated_at),
+                stats.contribution(row.status, row.assigned_to, row.department_id, row.created_at, row.updated_at,
+                                   started.get(row.id), now),
             )
-        )).scalars().all()
 
-        for task in tasks_to_overdue:
-            task.status = TaskStatusEnum.overdue
-            session.add(task)
+        # 2) Истёк срок проверки (12ч в submitted) - штраф и escalated
+        rows = (await session.execute(
+            update(Task)
+            .where(
+                Task.status == TaskStatusEnum.submitted,
+                Task.due_at <= now
+            )
+            .values(status=TaskStatusEnum.escalated, due_at=None)
+            .returning(Task.id, Task.assigned_to, Task.department_id, Task.created_at, Task.updated_at)
+            .execution_options(synchronize_session=False)
+        )).all()
+        started = await stats.started_at(session, [row.id for row in rows])
+        for row in rows:
+            if row.assigned_to:
+                penalties.append(points.PointsChange(row.assigned_to, -ESCALATION_PENALTY, points.ESCALATION, row.id))
+            transitions.append((row.id, TaskStatusEnum.submitted, TaskStatusEnum.escalated))
+            delta.change(
+                stats.contribution(TaskStatusEnum.submitted, row.assigned_to, row.department_id, row.created_at, row.updated_at),
+                stats.contribution(TaskStatusEnum.escalated, row.assigned_to, row.department_id, row.created_at, row.updated_at,
+                                   started.get(row.id), now),
+            )
 
-            if task.assigned_to:
-                user = await session.get(User, task.assigned_to)
-                if user:
-                    await adjust_points(user, -10, session)
+        # 3) Штрафы - одним UPDATE по всем пользователям и записи в журнал баллов
+        balances = await points.apply(session, penalties, delta)
+        await delta.apply(session)
+        await session.commit()
 
-            if task.department_id:
-                manager = (await session.execute(
-                    select(User).where(
-                        User.department_id == task.department_id,
-                        User.role == RoleEnum.manager,
-                        User.is_active == True
-                    )
-                )).scalars().first()
+    for task_id, from_status, to_status in transitions:
+        task_events.record(task_id, to_status, from_status, at=now)
+    leaderboard.update_points(balances)
 
-                if manager:
-                    task.assigned_to = manager.id
-                    task.status = TaskStatusEnum.escalated
-                    session.add(task)
-                    await send_manager_notification(manager.id, task)
+    # Уведомления - только после коммита; несколько эскалаций одному руководителю уйдут дайджестом
+    await outbox.send_many(
+        (manager_id, f"#{task.id} '{task.title}'", "escalation") for manager_id, task in notifications
+    )
+    return len(transitions)
 
-        await session.commit()
+@cluster_job(minutes=ESCALATION_SWEEP_MINUTES)
+async def check_tasks_escalation():
+    # Страховка: сроки задач, созданных в других процессах или пропущенных из-за ошибки
+    return await escalate_due()
 
-        # 2) Старше 12ч в submitted - штраф и escalated
-        tasks_submitted = (await session.execute(
-            select(Task).where(
-                Task.status == TaskStatusEnum.submitted,
-                Task.updated_at <= now - timedelta(hours=12)
-            )
-        )).scalars().all()
+@cluster_job(hours=6, next_run_time=datetime.now())
+async def reconcile_stats():
+    # Периодически пересчитываем предрассчитанную статистику, чтобы исправить расхождения
+    async with AsyncSessionLocal() as session:
+        await stats.reconcile(session)
+        await session.commit()
 
-        for task in tasks_submitted:
-            if task.assigned_to:
-                user = await session.get(User, task.assigned_to)
-                if user:
-                    await adjust_points(user, -10, session)
-            task.status = TaskStatusEnum.escalated
-            session.add(task)
+@cluster_job(hours=1)
+async def cleanup_fsm_states():
+    # Удаляем брошенные диалоги с истёкшим TTL
+    return await delete_expired_states()
 
-        await session.commit()
+if DEDUP_DB:
+    @cluster_job(hours=1)
+    async def cleanup_processed_updates():
+        # Окно дедупликации: старые update_id Telegram уже не повторит
+        return await delete_old_updates()
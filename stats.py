@@ -0,0 +1,281 @@
+from collections import defaultdict, namedtuple
+from sqlalchemy import select, func, and_, text
+from sqlalchemy.dialects.postgresql import insert
+import points
+from models import User, Department, Task, TaskStatusEnum, TaskEvent, UserStats, DepartmentStats
+
+# Ключ advisory lock: дельты берут его разделяемо, полный пересчёт - монопольно,
+# чтобы пересчёт не затёр дельту, закоммиченную между его чтением и записью
+STATS_LOCK_KEY = 7_202_402
+
+# Статусы, для которых считаем время выполнения
+FINISHED_STATUSES = (TaskStatusEnum.done, TaskStatusEnum.escalated, TaskStatusEnum.overdue)
+
+# Вклад одной задачи в статистику: кому засчитана, в какой отдел и сколько секунд выполнялась
+# (finished_seconds = None, если задача не завершена)
+TaskContribution = namedtuple("TaskContribution", "user_id department_id finished_seconds")
+
+def contribution(status, user_id, department_id, created_at, updated_at, started_at=None, finished_at=None):
+    finished_seconds = None
+    if status in FINISHED_STATUSES:
+        if started_at and finished_at:
+            # Точное время из журнала: от взятия в работу до завершения
+            delta = (finished_at - started_at).total_seconds()
+        elif created_at and updated_at:
+            # Журнала нет - берем разницу между created_at и updated_at, как упрощение
+            delta = (updated_at - created_at).total_seconds()
+        else:
+            delta = 0
+        if delta > 0:
+            finished_seconds = delta
+    return TaskContribution(user_id, department_id, finished_seconds)
+
+def task_contribution(task):
+    return contribution(task.status, task.assigned_to, task.department_id, task.created_at, task.updated_at)
+
+def make_stats(points, total_tasks, avg_seconds, penalties=None):
+    return {
+        "points": points or 0,
+        "penalties": penalties or 0,
+        "total_tasks": total_tasks or 0,
+        "avg_time_hours": round(float(avg_seconds) / 3600, 2) if avg_seconds else 0,
+    }
+
+# --- Инкрементальное обновление ---
+
+class StatsDelta:
+    """Накапливает изменения статистики и применяет их одним upsert на таблицу."""
+
+    def __init__(self):
+        self.users = defaultdict(lambda: [0, 0, 0.0, 0])
+        self.departments = defaultdict(lambda: [0, 0, 0, 0.0])
+
+    def _add(self, contribution, sign):
+        finished = contribution.finished_seconds is not None
+        seconds = contribution.finished_seconds or 0.0
+        if contribution.user_id:
+            row = self.users[contribution.user_id]
+            row[0] += sign
+            row[1] += sign * finished
+            row[2] += sign * seconds
+        if contribution.department_id:
+            row = self.departments[contribution.department_id]
+            row[1] += sign
+            row[2] += sign * finished
+            row[3] += sign * seconds
+
+    def change(self, before, after):
+        if before == after:
+            return self
+        if before is not None:
+            self._add(before, -1)
+        if after is not None:
+            self._add(after, 1)
+        return self
+
+    def add_penalty(self, user_id, amount):
+        if user_id and amount:
+            self.users[user_id][3] += amount
+        return self
+
+    def add_points(self, department_id, delta):
+        if department_id and delta:
+            self.departments[department_id][0] += delta
+        return self
+
+    async def apply(self, session):
+        users = [
+            {"user_id": k, "total_tasks": v[0], "finished_tasks": v[1], "finished_seconds": v[2], "penalties": v[3]}
+            for k, v in self.users.items() if any(v)
+        ]
+        departments = [
+            {"department_id": k, "points": v[0], "total_tasks": v[1], "finished_tasks": v[2], "finished_seconds": v[3]}
+            for k, v in self.departments.items() if any(v)
+        ]
+        if users or departments:
+            # Держится до конца транзакции вызывающего
+            await session.execute(text("SELECT pg_advisory_xact_lock_shared(:key)"), {"key": STATS_LOCK_KEY})
+        if users:
+            stmt = insert(UserStats).values(users)
+            await session.execute(stmt.on_conflict_do_update(
+                index_elements=[UserStats.user_id],
+                set_={
+                    "total_tasks": UserStats.total_tasks + stmt.excluded.total_tasks,
+                    "finished_tasks": UserStats.finished_tasks + stmt.excluded.finished_tasks,
+                    "finished_seconds": UserStats.finished_seconds + stmt.excluded.finished_seconds,
+                    "penalties": UserStats.penalties + stmt.excluded.penalties,
+                },
+            ))
+        if departments:
+            stmt = insert(DepartmentStats).values(departments)
+            await session.execute(stmt.on_conflict_do_update(
+                index_elements=[DepartmentStats.department_id],
+                set_={
+                    "points": DepartmentStats.points + stmt.excluded.points,
+                    "total_tasks": DepartmentStats.total_tasks + stmt.excluded.total_tasks,
+                    "finished_tasks": DepartmentStats.finished_tasks + stmt.excluded.finished_tasks,
+                    "finished_seconds": DepartmentStats.finished_seconds + stmt.excluded.finished_seconds,
+                },
+            ))
+        self.users.clear()
+        self.departments.clear()
+
+async def record_task_change(session, before, after):
+    """Учесть изменение задачи (before/after - TaskContribution или None). Коммит - на вызывающем."""
+    await StatsDelta().change(before, after).apply(session)
+
+# --- Чтение (одна строка на пользователя/отдел) ---
+
+def _avg_seconds(table):
+    return (table.finished_seconds / func.nullif(table.finished_tasks, 0)).label("avg_seconds")
+
+def user_stats_select(user_ids=None):
+    q = (
+        select(User.id, User.points, UserStats.total_tasks, _avg_seconds(UserStats), UserStats.penalties)
+        .outerjoin(UserStats, UserStats.user_id == User.id)
+    )
+    if user_ids is not None:
+        q = q.where(User.id.in_(user_ids))
+    return q
+
+def department_stats_select(department_ids=None):
+    q = (
+        select(Department.id, DepartmentStats.points, DepartmentStats.total_tasks, _avg_seconds(DepartmentStats))
+        .outerjoin(DepartmentStats, DepartmentStats.department_id == Department.id)
+    )
+    if department_ids is not None:
+        q = q.where(Department.id.in_(department_ids))
+    return q
+
+async def user_stats(session, user_ids=None):
+    """
+    Статистика по пользователям: {user_id: stats}.
+    Если user_ids не задан - по всем пользователям.
+    """
+    rows = (await session.execute(user_stats_select(user_ids))).all()
+    return {row.id: make_stats(row.points, row.total_tasks, row.avg_seconds, row.penalties) for row in rows}
+
+async def department_stats(session, department_ids=None):
+    """
+    Статистика по отделам: {department_id: stats}.
+    Баллы отдела - сумма баллов его сотрудников.
+    """
+    rows = (await session.execute(department_stats_select(department_ids))).all()
+    return {row.id: make_stats(row.points, row.total_tasks, row.avg_seconds) for row in rows}
+
+# --- Время выполнения по журналу task_events ---
+
+async def started_at(session, task_ids) -> dict:
+    """{task_id: момент взятия в работу} по журналу (индексный поиск по task_id)."""
+    if not task_ids:
+        return {}
+    rows = (await session.execute(
+        select(TaskEvent.task_id, func.min(TaskEvent.at)).where(
+            TaskEvent.task_id.in_(list(task_ids)),
+            TaskEvent.to_status == TaskStatusEnum.in_progress
+        ).group_by(TaskEvent.task_id)
+    )).all()
+    return dict(rows)
+
+# --- Полный пересчёт по таблице tasks (GROUP BY в БД) ---
+
+def _event_bounds(task_ids=None):
+    q = select(
+        TaskEvent.task_id,
+        func.min(TaskEvent.at).filter(TaskEvent.to_status == TaskStatusEnum.in_progress).label("started_at"),
+        func.max(TaskEvent.at).filter(TaskEvent.to_status.in_(FINISHED_STATUSES)).label("finished_at"),
+    )
+    if task_ids is not None:
+        q = q.where(TaskEvent.task_id.in_(task_ids))
+    return q.group_by(TaskEvent.task_id).subquery()
+
+def _duration_seconds(bounds):
+    # По журналу, если он есть; иначе - разница между created_at и updated_at
+    return func.coalesce(
+        func.extract("epoch", bounds.c.finished_at - bounds.c.started_at),
+        func.extract("epoch", Task.updated_at - Task.created_at),
+    )
+
+def _task_totals(*columns, bounds=None):
+    bounds = _event_bounds() if bounds is None else bounds
+    duration = _duration_seconds(bounds)
+    finished = and_(Task.status.in_(FINISHED_STATUSES), duration > 0)
+    return (
+        select(
+            *columns,
+            func.count(Task.id).label("total_tasks"),
+            func.count(Task.id).filter(finished).label("finished_tasks"),
+            func.coalesce(func.sum(duration).filter(finished), 0).label("finished_seconds"),
+        )
+        .select_from(Task)
+        .outerjoin(bounds, bounds.c.task_id == Task.id)
+    )
+
+def _task_aggregates(key_column):
+    return _task_totals(key_column.label("key")).where(key_column.isnot(None)).group_by(key_column)
+
+async def overall_stats(session):
+    departments = (await session.execute(
+        select(func.sum(DepartmentStats.total_tasks), func.sum(DepartmentStats.finished_tasks),
+               func.sum(DepartmentStats.finished_seconds))
+    )).one()
+    # Задач без отдела нет в роллапах отделов: их немного, считаем напрямую (индекс по department_id)
+    no_department = Task.department_id.is_(None)
+    orphans = (await session.execute(
+        _task_totals(bounds=_event_bounds(select(Task.id).where(no_department))).where(no_department)
+    )).one()
+    total_tasks, finished, seconds = ((a or 0) + (b or 0) for a, b in zip(departments, orphans))
+    return make_stats(None, total_tasks, seconds / finished if finished else None)
+
+async def reconcile(session):
+    """
+    Пересчитать user_stats/department_stats с нуля и исправить расхождения.
+    На время пересчёта (до commit вызывающего) запись дельт ждёт.
+    """
+    await session.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": STATS_LOCK_KEY})
+    tasks = _task_aggregates(Task.assigned_to).subquery()
+    # Штрафы сверяем с журналом баллов
+    ledger = points.ledger_totals()
+    source = (
+        select(
+            User.id,
+            func.coalesce(tasks.c.total_tasks, 0),
+            func.coalesce(tasks.c.finished_tasks, 0),
+            func.coalesce(tasks.c.finished_seconds, 0),
+            func.coalesce(ledger.c.penalties, 0),
+        )
+        .outerjoin(tasks, tasks.c.key == User.id)
+        .outerjoin(ledger, ledger.c.user_id == User.id)
+    )
+    columns = ("total_tasks", "finished_tasks", "finished_seconds", "penalties")
+    stmt = insert(UserStats).from_select(["user_id", *columns], source)
+    await session.execute(stmt.on_conflict_do_update(
+        index_elements=[UserStats.user_id],
+        set_={c: getattr(stmt.excluded, c) for c in columns},
+    ))
+
+    user_points = (
+        select(User.department_id.label("key"), func.sum(User.points).label("points"))
+        .where(User.department_id.isnot(None))
+        .group_by(User.department_id)
+        .subquery()
+    )
+    tasks = _task_aggregates(Task.department_id).subquery()
+    source = (
+        select(
+            Department.id,
+            func.coalesce(user_points.c.points, 0),
+            func.coalesce(tasks.c.total_tasks, 0),
+            func.coalesce(tasks.c.finished_tasks, 0),
+            func.coalesce(tasks.c.finished_seconds, 0),
+        )
+        .outerjoin(user_points, user_points.c.key == Department.id)
+        .outerjoin(tasks, tasks.c.key == Department.id)
+    )
+    stmt = insert(DepartmentStats).from_select(
+        ["department_id", "points", "total_tasks", "finished_tasks", "finished_seconds"], source
+    )
+    await session.execute(stmt.on_conflict_do_update(
+        index_elements=[DepartmentStats.department_id],
+        set_={c: getattr(stmt.excluded, c) for c in ("points", "total_tasks", "finished_tasks", "finished_seconds")},
+    ))